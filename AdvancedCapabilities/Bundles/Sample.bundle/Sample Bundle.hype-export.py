@@ -15,9 +15,9 @@ import sys
 import os
 
 # main
-def main():
-	# prepare bundle instance
-	bundle = HypeBundle(
+def main(bundle=None):
+	# prepare bundle instance (the manager hands one in when running us in-process)
+	bundle = bundle or HypeBundle(
 		{
 			"current_script_version"		: 1,
 			"version_info_url" 				: "https://hypebundles.de/Version/LogicAndExpressions.php", # only returns a version number
@@ -66,12 +66,28 @@ def main():
 		}
 	])
 
+	# tell the manager what we return and that it can cache it
+	bundle.register_capabilities({
+		"insert_points" : [
+			'insert_at_head_start',
+			'insert_at_head_end',
+			'insert_at_body_start',
+			'insert_at_body_end',
+			'insert_into_hype_document_load',
+			'insert_into_generated_script',
+			# 'patch_generated_script', # declare it when returning patches
+		],
+		"depends_on" : [], # labels of bundles to run first, e.g. ["Logic and Expressions"]
+		"deterministic" : True,
+	})
+
 	if bundle.args.get_options:
 
 		bundle.exit_with_result({
 			"document_arguments" : bundle.get_document_arguments(),
 			"extra_actions" : bundle.get_extra_actions(),
 			"save_options" : bundle.get_save_options(),
+			"capabilities" : bundle.get_capabilities(),
 			"min_hype_build_version" : "734", # Hype 4 release with working all_document_arguments_by_export_script
 			# "max_hype_build_version" : "798" # uncomment to exclude from Hype 5 (Beta and beyond)
 		})
@@ -97,12 +113,17 @@ def main():
 		bundle.log ( bundle.template_variables("""
 		what hello world ${hello} ${world} und ${abra} ${_peter} and ${_ff}
 		${peter}
+		${ifdef world}world is set${else}world is not set${endif}
 		"""))
 
 		insert_at_head_start = """
 		<!-- inserted at head start -->
 		"""
 
+		# ship static files with the export (declared with the result, the manager
+		# places them, stored once and hardlinked on previews)
+		# stylesheet = bundle.provide_asset(os.path.join(bundle.folder, 'sample.css'))
+
 		insert_at_head_end = """
 		<!-- inserted at head end -->
 		"""
@@ -138,6 +159,13 @@ def main():
 			'insert_at_body_end' : insert_at_body_end,
 			'insert_into_hype_document_load' : insert_into_hype_document_load,
 			'insert_into_generated_script' : insert_into_generated_script,
+			# patches are applied to every generated script before functions are unpacked
+			# 'patch_generated_script' : [
+			# 	{ 'find' : 'console.log("debug")', 'replace' : '' },
+			# 	{ 'regex' : r'setTimeout\((\w+),0\)', 'replace' : r'requestAnimationFrame(\1)', 'optional' : True },
+			# ],
+			# 'cache' : False, # opt out of the manager result cache
+			# 'cache' : { 'files' : ['/path/to/data.json'] }, # also invalidate on file changes
 		})
 
 # run main
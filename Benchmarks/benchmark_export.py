@@ -0,0 +1,243 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#	benchmark_export.py
+#	Runs the manager's preview/export path on synthetic Hype staging folders
+#	with M dummy bundles and N Hype functions and reports the wall time of every
+#	phase (read from the timing records in the manager log). Works offline, the
+#	Closure step uses a stub local compiler that only echoes the code
+#
+#	Usage: python benchmark_export.py [--bundles 1,4,16] [--functions 100,1000]
+#	       [--scripts 1] [--runs 3] [--closure] [--warm] [--export] [--keep]
+#
+#	MIT License
+#	Copyright (c) 2021 Max Ziebell
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+repository_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(repository_folder, 'ManagerExtension.bundle', 'import'))
+from hypebundle import BundleLogger
+from benchmark_rewrite import make_generated_script
+
+manager_filename = 'Advanced Capabilities.hype-export.py'
+
+# phases logged by the manager in the order they run
+phases = ['registry', 'bundles', 'generated scripts', 'html', 'finalize']
+
+
+dummy_bundle = '''#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#	Dummy bundle generated by benchmark_export.py
+#
+
+import sys
+import os
+
+def main(bundle=None):
+	bundle = bundle or HypeBundle({})
+
+	bundle.register_document_arguments([
+		{
+			"label" : "Bench %(index)d",
+		},
+		{
+			"indent" : 1,
+			"label" : "value",
+			"variable" : "bench_value",
+			"default" : "%(index)d",
+		},
+	])
+
+	if bundle.args.get_options:
+		bundle.exit_with_result({
+			"document_arguments" : bundle.get_document_arguments(),
+		})
+
+	elif bundle.args.get_inserts:
+		bundle.exit_with_result({
+			'insert_at_head_end' : bundle.template_variables('<meta name="bench-%(index)d" content="${bench_value}">'),
+			'insert_at_body_end' : '<!-- bench %(index)d -->',
+			'insert_into_hype_document_load' : 'hypeDocument.bench%(index)d = function(){ return %(index)d; };',
+			'insert_into_generated_script' : 'console.log("bench %(index)d");',
+		})
+
+if __name__ == "__main__":
+	import_path = 'com.tumult.Hype4/ManagerExtension.bundle/import/'
+	sys.path.append(os.path.join(__file__.split('com.tumult.Hype4', 1)[0], import_path))
+	from hypebundle import *
+	main()
+'''
+
+stub_compiler = '''#!%(python)s
+# stub Closure Compiler: echoes the code (stdin or the --js inputs) and reports no issues
+import sys
+inputs = [sys.argv[index+1] for index, arg in enumerate(sys.argv) if arg == '--js']
+sys.stdout.write("\\n".join(open(path).read() for path in inputs) if inputs else sys.stdin.read())
+sys.stderr.write('[]')
+'''
+
+index_html = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>index</title>
+</head>
+<body>
+%s
+</body>
+</html>
+'''
+
+
+
+'''
+Synthetic trees
+'''
+
+def make_extensions_tree(root, bundle_count):
+	# fake com.tumult.Hype4 with a copy of the manager and bundle_count dummy bundles
+	extensions_folder = os.path.join(root, 'com.tumult.Hype4')
+	shutil.copytree(os.path.join(repository_folder, 'ManagerExtension.bundle'), os.path.join(extensions_folder, 'ManagerExtension.bundle'), ignore=shutil.ignore_patterns('errors.log', '*.pyc'))
+	for index in range(bundle_count):
+		folder = os.path.join(extensions_folder, 'AdvancedCapabilities', 'Bundles', 'Bench%d.bundle' % index)
+		os.makedirs(folder)
+		with open(os.path.join(folder, 'Bench %d.hype-export.py' % index), 'w') as f:
+			f.write(dummy_bundle % { 'index' : index })
+	for name in ['Cache', 'Logs']:
+		os.makedirs(os.path.join(extensions_folder, 'AdvancedCapabilities', name))
+
+	compiler_path = os.path.join(root, 'closure-stub')
+	with open(compiler_path, 'w') as f:
+		f.write(stub_compiler % { 'python' : sys.executable })
+	os.chmod(compiler_path, 0755)
+	return extensions_folder, compiler_path
+
+
+def make_staging_folder(run_folder, function_count, script_count, bundle_count, closure, compiler_path):
+	# staging folder "index" with index.html, script_count generated scripts and the export info
+	staging_path = os.path.join(run_folder, 'index')
+	scripts = []
+	for index in range(script_count):
+		resources = os.path.join(staging_path, 'doc%d.hyperesources' % index)
+		os.makedirs(resources)
+		with open(os.path.join(resources, 'doc%d_hype_generated_script.js' % index), 'w') as f:
+			f.write(make_generated_script(function_count))
+		scripts.append('<script src="doc%d.hyperesources/doc%d_hype_generated_script.js"></script>' % (index, index))
+	with open(os.path.join(staging_path, 'index.html'), 'w') as f:
+		f.write(index_html % "\n".join(scripts))
+
+	manager_arguments = {}
+	if closure:
+		manager_arguments = {
+			u'╰ compile on export' : 'on',
+			u'╰ compile on preview' : 'on',
+			u'╰ local compiler path' : compiler_path,
+		}
+	all_arguments = { manager_filename : manager_arguments }
+	for index in range(bundle_count):
+		all_arguments['Bench %d.hype-export.py' % index] = { u'╰ value' : str(index) }
+
+	export_info_path = os.path.join(run_folder, 'export_info.json')
+	with open(export_info_path, 'w') as f:
+		json.dump({ 'html_filename' : 'index.html', 'all_document_arguments_by_export_script' : all_arguments }, f)
+	return staging_path, export_info_path
+
+
+
+'''
+Runs
+'''
+
+def run_manager(extensions_folder, run_folder, staging_path, export_info_path, is_preview):
+	# run the manager like Hype does and return wall time and phase timings
+	log_path = os.path.join(extensions_folder, 'AdvancedCapabilities', 'Logs', 'ManagerExtension.bundle.log')
+	if os.path.exists(log_path):
+		os.remove(log_path)
+
+	argv = [
+		sys.executable, os.path.join(extensions_folder, 'ManagerExtension.bundle', manager_filename),
+		'--modify_staging_path', staging_path,
+		'--destination_path', os.path.join(run_folder, 'destination'),
+		'--is_preview', str(is_preview),
+		'--export_uid', 'benchmark',
+		'--export_info_json_path', export_info_path,
+		'--hype_version', '4.1.5',
+		'--hype_build', '734',
+	]
+	start = time.time()
+	output = subprocess.check_output(argv, stderr=subprocess.STDOUT, cwd=run_folder)
+	wall = time.time() - start
+	if '"result": true' not in output:
+		raise RuntimeError('manager failed:\n'+output)
+
+	timings = {}
+	slowest_bundle = 0
+	with open(log_path, 'r') as f:
+		for timestamp, step, seconds in BundleLogger.timing_pattern.findall(f.read()):
+			if step.startswith('bundle '):
+				slowest_bundle = max(slowest_bundle, float(seconds))
+			else:
+				timings[step] = float(seconds)
+	timings['slowest bundle'] = slowest_bundle
+	timings['wall'] = wall
+	return timings
+
+
+def benchmark(bundle_count, function_count, args):
+	# best of args.runs for every phase
+	root = tempfile.mkdtemp(prefix='acme-benchmark-')
+	try:
+		extensions_folder, compiler_path = make_extensions_tree(root, bundle_count)
+		cache_folder = os.path.join(extensions_folder, 'AdvancedCapabilities', 'Cache')
+		best = {}
+		for run in range(args.runs):
+			# cold runs start without caches
+			if not args.warm:
+				shutil.rmtree(cache_folder, ignore_errors=True)
+				os.makedirs(cache_folder)
+			run_folder = os.path.join(root, 'run%d' % run)
+			os.makedirs(run_folder)
+			staging_path, export_info_path = make_staging_folder(run_folder, function_count, args.scripts, bundle_count, args.closure, compiler_path)
+			timings = run_manager(extensions_folder, run_folder, staging_path, export_info_path, not args.export)
+			for key, value in timings.items():
+				best[key] = min(best.get(key, value), value)
+		return best
+	finally:
+		if args.keep:
+			print 'kept', root
+		else:
+			shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--bundles', default='1,4,16', help='comma separated bundle counts')
+	parser.add_argument('--functions', default='100,1000', help='comma separated function counts per script')
+	parser.add_argument('--scripts', type=int, default=1, help='generated scripts per export')
+	parser.add_argument('--runs', type=int, default=3, help='runs per combination (best is reported)')
+	parser.add_argument('--closure', action='store_true', help='compile with the stub local compiler')
+	parser.add_argument('--warm', action='store_true', help='keep caches between runs')
+	parser.add_argument('--export', action='store_true', help='export instead of preview')
+	parser.add_argument('--keep', action='store_true', help='keep the synthetic trees')
+	args = parser.parse_args()
+
+	columns = phases + ['slowest bundle', 'wall']
+	print '%8s %10s' % ('bundles', 'functions') + ''.join('%19s' % column for column in columns)
+	for bundle_count in [int(value) for value in args.bundles.split(',')]:
+		for function_count in [int(value) for value in args.functions.split(',')]:
+			timings = benchmark(bundle_count, function_count, args)
+			print '%8d %10d' % (bundle_count, function_count) + ''.join('%19.4f' % timings.get(column, 0) for column in columns)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#	benchmark_memory.py
+#	Measures peak memory (RSS) of rewriting generated scripts of growing size,
+#	each measurement runs in a fresh process. The streaming rewrite shows about
+#	the script size as mapped pages of the file (clean and reclaimable by the OS),
+#	the legacy rewrite holds several private copies of the script
+#
+#	Usage: python benchmark_memory.py [--legacy] [--sizes 8,32,128] [--functions 200]
+#
+#	MIT License
+#	Copyright (c) 2021 Max Ziebell
+#
+
+import os
+import sys
+import re
+import argparse
+import resource
+import subprocess
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ManagerExtension.bundle', 'import'))
+from scriptrewriter import *
+from benchmark_rewrite import make_generated_script
+
+
+def make_generated_script_file(filepath, size_mb, function_count):
+	# generated script with function_count Hype functions and an inline
+	# data URI padding it to about size_mb megabytes
+	generated_script = make_generated_script(function_count)
+	with open(filepath, 'wb') as f:
+		f.write(generated_script[:-len('})();\n')])
+		f.write('var d="data:image/png;base64,')
+		chunk = 'A'*(1024*1024)
+		for i in range(size_mb):
+			f.write(chunk)
+		f.write('";})();\n')
+
+
+def rewrite_streaming(filepath):
+	rewrite_generated_script_file(filepath, 'index', lambda hype_functions: "".join(hype_functions))
+
+
+def rewrite_legacy(filepath):
+	# read, replace, unpack and save like the manager did before streaming
+	with open(filepath, 'r') as f:
+		generated_script = f.read()
+	generated_script = generated_script.replace('s:"hypeDocument.', 's:"HYPE.documents[\\"index\\"].')
+	generated_script, hype_functions = unpack_hype_functions(generated_script, 'index')
+	generated_script = "".join(hype_functions)+"\n"+generated_script
+	with open(filepath, 'w') as f:
+		f.write(generated_script)
+
+
+def peak_rss_mb():
+	# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak/(1024.0*1024.0) if sys.platform == 'darwin' else peak/1024.0
+
+
+def measure(mode, size_mb, function_count):
+	# run one rewrite in a fresh interpreter and return its peak RSS in MB
+	output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', mode, '--sizes', str(size_mb), '--functions', str(function_count)])
+	return float(output.strip())
+
+
+def child(mode, size_mb, function_count):
+	folder = tempfile.mkdtemp()
+	filepath = os.path.join(folder, 'index_hype_generated_script.js')
+	try:
+		make_generated_script_file(filepath, size_mb, function_count)
+		baseline = peak_rss_mb()
+		(rewrite_legacy if mode == 'legacy' else rewrite_streaming)(filepath)
+		# report growth over what creating the file needed
+		print '%.1f' % max(peak_rss_mb()-baseline, 0)
+	finally:
+		os.remove(filepath)
+		os.rmdir(folder)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--sizes', default='8,32,128')
+	parser.add_argument('--functions', type=int, default=200)
+	parser.add_argument('--legacy', action='store_true', help='also measure read, replace and save')
+	parser.add_argument('--child', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.child:
+		child(args.child, int(args.sizes), args.functions)
+		return
+
+	print '%10s %16s' % ('script MB', 'peak RSS +MB') + ('%16s' % 'legacy +MB' if args.legacy else '')
+	for size in [int(value) for value in args.sizes.split(',')]:
+		line = '%10d %16.1f' % (size, measure('streaming', size, args.functions))
+		if args.legacy:
+			line += '%16.1f' % measure('legacy', size, args.functions)
+		print line
+
+
+if __name__ == "__main__":
+	main()
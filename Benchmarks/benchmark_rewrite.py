@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#	benchmark_rewrite.py
+#	Measures unpacking Hype functions from generated scripts of growing size
+#
+#	Usage: python benchmark_rewrite.py [--legacy] [--sizes 100,200,400,800]
+#
+#	MIT License
+#	Copyright (c) 2021 Max Ziebell
+#
+
+import os
+import sys
+import time
+import re
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ManagerExtension.bundle', 'import'))
+from scriptrewriter import *
+
+
+def make_generated_script(function_count, body_lines=20):
+	# synthetic generated script with function_count Hype functions
+	functions = []
+	for i in range(function_count):
+		body = '\\n'.join(['\\tconsole.log(\\"function %d line %d\\");' % (i, line) for line in range(body_lines)])
+		functions.append('{name:"function%d",source:"function(hypeDocument, element, event) {\\t\\n%s\\n}",identifier:"%d"}' % (i, body, i))
+	return '(function(){var f=[' + ','.join(functions) + '];s:"hypeDocument.documentName";})();\n'
+
+
+def legacy_unpack_hype_functions(generated_script, hype_document_name):
+	# the replace loop used before scriptrewriter (for comparison)
+	hype_functions = ''
+	for m in re.finditer(hype_function_pattern, generated_script):
+		new_name = 'HYPE_functions[\\"'+hype_document_name+'\\"].'+m.group(1)
+		generated_script = generated_script.replace(m.group(2), new_name)
+		function_raw = m.group(2).replace(hype_function_signature, hype_function_signature+"\n")
+		hype_functions = hype_functions+"\n"+new_name.decode('string_escape')+" = "+function_raw.decode('string_escape')+";\n"
+		hype_functions += '//'+m.group(2)+"\n"
+	return generated_script, hype_functions
+
+
+def measure(function, generated_script, repeat=3):
+	# best of repeat runs in seconds
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		function(generated_script, 'index')
+		duration = time.time() - start
+		best = duration if best is None else min(best, duration)
+	return best
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--sizes', default='100,200,400,800,1600')
+	parser.add_argument('--legacy', action='store_true', help='also measure the replace loop')
+	args = parser.parse_args()
+
+	print '%10s %12s %12s %14s' % ('functions', 'script KB', 'seconds', 'us/function') + ('%12s' % 'legacy' if args.legacy else '')
+	for size in [int(value) for value in args.sizes.split(',')]:
+		generated_script = make_generated_script(size)
+		duration = measure(unpack_hype_functions, generated_script)
+		line = '%10d %12d %12.4f %14.1f' % (size, len(generated_script)/1024, duration, duration/size*1000000)
+		if args.legacy:
+			line += '%12.4f' % measure(legacy_unpack_hype_functions, generated_script, 1)
+		print line
+
+
+if __name__ == "__main__":
+	main()
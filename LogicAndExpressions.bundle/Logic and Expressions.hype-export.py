@@ -11,9 +11,9 @@ import sys
 import os
 
 # main
-def main():
-	# prepare bundle instance
-	bundle = HypeBundle()
+def main(bundle=None):
+	# prepare bundle instance (the manager hands one in when running us in-process)
+	bundle = bundle or HypeBundle()
 
 	# reset log
 	bundle.log('Running '+bundle.folder_name, True)
@@ -54,12 +54,19 @@ def main():
 		},
 	])
 
+	# tell the manager what we return and that it can cache it
+	bundle.register_capabilities({
+		"insert_points" : ['insert_into_hype_document_load'],
+		"deterministic" : True,
+	})
+
 
 	if bundle.args.get_options:
 
 		bundle.exit_with_result({
 			"extra_actions" : bundle.get_extra_actions(),
 			"save_options" : bundle.get_save_options(),
+			"capabilities" : bundle.get_capabilities(),
 			"min_hype_build_version" : "734", # Hype 4 release with working all_document_arguments_by_export_script
 			# "max_hype_build_version" : "798" # uncomment to exclude from Hype 5 (Beta and beyond)
 		})
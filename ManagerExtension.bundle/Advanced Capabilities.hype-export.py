@@ -13,6 +13,7 @@
 #	 v1.0.6 name change, bundles, bundle management
 #	 v1.0.7 improved cache, added closure warning on preview
 #	 v1.0.8 name change, refactored to use HypeBaseBundle
+#	 v1.0.9 run bundles concurrently
 #
 
 
@@ -26,8 +27,24 @@ import string
 import shutil
 import re
 import subprocess
+import traceback
+import time
 #from subprocess import CalledProcessError
 
+# append bundle import path to sys path and mount HypeBundle class
+sys.path.append(os.path.join(os.path.dirname(__file__), 'import/'))
+
+from hypebundle import *
+from closurecompiler import *
+from bundlerunner import *
+from scriptrewriter import *
+from scriptpatcher import *
+from bundleregistry import *
+from bundleworker import *
+from htmlinject import *
+from exportfinalizer import *
+from exporttrace import *
+
 script_version = 'v1.0.9'
 
 #
@@ -40,12 +57,16 @@ def main():
 
 	bundle = ManagerExtensionBundle(
 		{
+			"file"							: __file__, # also when loaded by the worker
 			"current_script_version"		: 1, #script_version
 			"version_info_url" 				: "https://hypebundles.de/Version/ManagerExtension.php",
 			"download_url" 					: "https://hypebundles.de/",
 		}
 	)
 
+	# time phases and bundles, spans also go to the log as timing records
+	trace = ExportTrace(lambda name, category, seconds: bundle.log_timing(name if category == 'phase' else category+' '+name, seconds))
+
 	menu_list = [
 		{
 			"label" : "Closure Compiler",
@@ -68,6 +89,11 @@ def main():
 			"variable" : "_closure_compiler_warnings",
 			"default" : False,
 		},
+		{
+			"indent" : 1,
+			"label" : "local compiler path",
+			"variable" : "_closure_compiler_local",
+		},
 		{	
 			"label" : ""
 		},
@@ -79,6 +105,70 @@ def main():
 			"label" : "disable error reporting",
 			"variable" : "_disable_javascript_errors",
 		},
+		{
+			"indent" : 1,
+			"label" : "parallel generated scripts",
+			"variable" : "_scripts_max_workers",
+			"default" : "4",
+		},
+		{	
+			"label" : "" 
+		},
+		{
+			"label" : "Bundle Execution",
+		},
+		{
+			"indent" : 1,
+			"label" : "parallel bundles",
+			"variable" : "_bundles_max_workers",
+			"default" : "4",
+		},
+		{
+			"indent" : 1,
+			"label" : "run bundles in-process",
+			"variable" : "_bundles_in_process",
+			"default" : False,
+		},
+		{
+			"indent" : 1,
+			"label" : "background worker",
+			"variable" : "_background_worker",
+			"default" : False,
+		},
+		{
+			"indent" : 1,
+			"label" : u"cache bundle results⁽²⁾",
+			"variable" : "_bundles_cache_results",
+		},
+		{
+			"indent" : 1,
+			"label" : "timeout per bundle (s)",
+			"variable" : "_bundles_timeout",
+			"default" : "60",
+		},
+		{
+			"indent" : 1,
+			"label" : u"skip failing bundles⁽²⁾",
+			"variable" : "_bundles_circuit_breaker",
+		},
+		{	
+			"label" : "" 
+		},
+		{
+			"label" : "Diagnostics",
+		},
+		{
+			"indent" : 1,
+			"label" : "show export profile",
+			"variable" : "_export_profile_overlay",
+			"default" : False,
+		},
+		{
+			"indent" : 1,
+			"label" : "profile with cProfile",
+			"variable" : "_export_cprofile",
+			"default" : False,
+		},
 		{	
 			"label" : "" 
 		},
@@ -89,19 +179,20 @@ def main():
 
 	# TODO get bundles that are by default on or off
 
-	for path, dirs, files in os.walk(bundle.bundles_folder):
-		for filename in fnmatch.filter(files, '*.hype-export.py'):
-			# make sure all bundles can be run
-			filepath = os.path.join(path, filename)
-			os.system("chmod 755 '"+filepath+"'")
-			# register in overview
-			label = filename.replace('.hype-export.py','')
-			identifier = '_bundle_'+filename.replace('.hype-export.py','')
-			menu_list.append({
-				"indent" : 1,
-				"label" : label,
-				"variable" : identifier,
-			})
+	# installed bundles (scanned once and refreshed incrementally)
+	registry = BundleRegistry(bundle.bundles_folder, os.path.join(bundle.cache_folder, 'bundles.json'))
+
+	# make sure all bundles can be run
+	with trace.span('registry'):
+		registry.fix_permissions()
+
+	for entry in registry.bundles():
+		# register in overview
+		menu_list.append({
+			"indent" : 1,
+			"label" : entry['label'],
+			"variable" : entry['identifier'],
+		})
 	
 
 	menu_list.extend([
@@ -110,6 +201,9 @@ def main():
 		},
 		{
 			"label" : "⁽¹⁾Type \"off\" to exclude Bundle",
+		},
+		{
+			"label" : "⁽²⁾Type \"off\" to disable",
 		}
 	])		
 
@@ -128,192 +222,267 @@ def main():
 	# if we are previewing or exporting
 	elif bundle.args.modify_staging_path != None:
 		
+		# profile the rest of the export if enabled (only this thread, not bundle threads)
+		if bundle.variable_is_enabled('_export_cprofile'):
+			trace.start_profiler()
+
 		# hype id	
 		hype_document_name = os.path.basename(bundle.args.modify_staging_path)
 
 		# use acme debugger interface on previews
 		acme_debugger = True
 
-		# read and prepare action helper
-		global hype_document_load
-		global prepend_to_hype_functions
-		global subprocess_error
-
-		# results for supported bundle returns
-		insert_at_head_start = []
-		insert_at_head_end = []
-		insert_at_body_start = []
-		insert_at_body_end = []
-		insert_into_hype_document_load = []
-		insert_into_generated_script = []
-		patch_generated_script = []
-
-		# arguments for calls
+		# arguments for calls (passed as is, no shell quoting needed)
 		bundle_args = [
 			'--get_inserts', 'True',
-			'--modify_staging_path', "'{}'".format(bundle.args.modify_staging_path),
-			'--destination_path', "'{}'".format(bundle.args.destination_path),
+			'--modify_staging_path', bundle.args.modify_staging_path,
+			'--destination_path', bundle.args.destination_path,
 			'--is_preview', str(bundle.args.is_preview),
 			'--export_uid', bundle.args.export_uid,
-			'--export_info_json_path', "'{}'".format(bundle.args.export_info_json_path),
+			'--export_info_json_path', bundle.args.export_info_json_path,
 			'--hype_version', bundle.args.hype_version,
 			'--hype_build', bundle.args.hype_build,
 		]
 
-		for path, dirs, files in os.walk(bundle.bundles_folder):
-			for filename in fnmatch.filter(files, '*.hype-export.py'):
-
-				# filepath and base filename
-				filepath = os.path.join(path, filename)
-				identifier = '_bundle_'+filename.replace('.hype-export.py','')
-
-				# check if the user disabled 
-				if not bundle.variable_is_disabled(identifier):
-
-					# subprocess
-					cmd ="python '"+filepath+"' "+(' '.join(bundle_args))
-
-					# run the subprocess
-					try:
-						pipe = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+		# collect enabled bundles in walk order
+		# check if the user disabled 
+		# and skip bundles that declared to insert nothing
+		bundle_entries = [entry for entry in registry.bundles() if not bundle.variable_is_disabled(entry['identifier']) and entry['capabilities'].get('insert_points') != []]
+		bundle_files = [entry['path'] for entry in bundle_entries]
+
+		# show error to user if a bundle fails
+		def error_result(output):
+			return {
+				'insert_at_body_start' : template_variables(subprocess_error, {
+					'subprocess_error': output
+				})
+			}
+
+		# stop bundles running longer than this (0 to let them run)
+		bundle_timeout = bundle.get_variable_as_int('_bundles_timeout', 60)
+
+		# run bundles in-process if enabled and supported by the bundle. A bundle
+		# stuck in-process can't be stopped, so with a timeout they run as subprocesses
+		in_process = bundle.variable_is_enabled('_bundles_in_process')
+		if in_process and bundle_timeout:
+			in_process = False
+			bundle.log('Bundles run as subprocesses, running them in-process needs the timeout set to 0', level='warning')
+
+		# reuse results of unchanged bundles unless the user disabled it
+		result_cache = None
+		if not bundle.variable_is_disabled('_bundles_cache_results'):
+			result_cache = BundleResultCache(os.path.join(bundle.cache_folder, 'Bundles'))
+
+		# remember durations and skip bundles failing again and again unless the user disabled it
+		health = BundleHealth(os.path.join(bundle.cache_folder, 'bundle_health.json'))
+		circuit_breaker = not bundle.variable_is_disabled('_bundles_circuit_breaker')
+
+		# notices about slow bundles (shown on previews)
+		notices = []
+
+		# run a bundle
+		def execute(filepath):
+			if in_process and registry.get(filepath)['capabilities']['in_process']:
+				result = run_bundle_in_process(filepath, bundle.args, bundle.export_info)
+				if result != None:
+					return result
+			return run_bundle(filepath, bundle_args, bundle_timeout)
+
+		# fetch a bundle result from cache or run the bundle (only bundles
+		# declaring themselves deterministic are cached, others may have side
+		# effects like copying files that a cached result would skip)
+		def fetch_result(filepath):
+			capabilities = registry.get(filepath)['capabilities']
+			key = None
+			if result_cache and capabilities.get('deterministic') == True:
+				key = result_cache.key(filepath, bundle.export_info, bundle.args)
+				result = result_cache.get(key)
+				if result != None:
+					return result
+
+			label = registry.get(filepath)['label']
+			if circuit_breaker and not health.allow(filepath):
+				return error_result('{} was skipped because it failed {} times in a row, it runs again in a few minutes (type "off" for "skip failing bundles" to always run it)'.format(label, health.max_failures))
+
+			start = time.time()
+			try:
+				result = restrict_result(execute(filepath), capabilities.get('insert_points'))
+			except BundleTimeout as e:
+				health.record(filepath, time.time() - start, 'timeout')
+				return error_result('{} was stopped after running {}s\n\n{}'.format(label, e.timeout, e.output))
+			except subprocess.CalledProcessError as e:
+				health.record(filepath, time.time() - start, 'failure')
+				return error_result(e.output)
+			except Exception:
+				health.record(filepath, time.time() - start, 'failure')
+				return error_result(traceback.format_exc())
+
+			# flag bundles using up more than half of their time
+			duration = time.time() - start
+			health.record(filepath, duration, 'success')
+			if bundle_timeout and duration > bundle_timeout / 2.0:
+				notices.append(template_variables(subprocess_error, {
+					'subprocess_error': '{} is slow, it took {:.1f}s of {}s allowed'.format(label, duration, bundle_timeout)
+				}))
+
+			if key:
+				result_cache.set(key, result)
+			return result
+
+		# log how long every bundle took (cache hits included)
+		def timed_fetch_result(filepath):
+			with trace.span(registry.get(filepath)['label'], 'bundle'):
+				return fetch_result(filepath)
+
+		# bundles run after the bundles they depend on, levels of independent
+		# bundles run concurrently and results are merged in level and walk order
+		levels, problems = dependency_levels(bundle_entries)
+		for problem in problems:
+			bundle.log(problem, level='warning')
+			notices.append(template_variables(subprocess_error, { 'subprocess_error': problem }))
+
+		executor = BundleExecutor(bundle.get_variable_as_int('_bundles_max_workers', 4))
+		results = []
+		patches = []
+		assets = []
+		with trace.span('bundles'):
+			for level in levels:
+				level_results = executor.map(timed_fetch_result, [entry['path'] for entry in level])
+				for entry, result in zip(level, level_results):
+					if isinstance(result, dict):
+						patches.extend(label_patches(entry['label'], result.get('patch_generated_script')))
+						if isinstance(result.get('assets'), list):
+							assets.extend(dict(asset, bundle=entry['label']) if isinstance(asset, dict) else asset for asset in result['assets'])
+				results.extend(level_results)
+		inserts = collect_inserts(results)
+		health.save()
+
+		# place the assets bundles declared (for cached results as well)
+		for problem in bundle.provide_assets(assets):
+			bundle.log(problem, level='warning')
+			notices.append(template_variables(subprocess_error, { 'subprocess_error': problem }))
 
-					# and show error to user if it fails
-					except CalledProcessError as e:
-						pipe = '===================='+json.dumps({
-							'result' : {
-								'insert_at_body_start' : template_variables(subprocess_error, {
-										'subprocess_error': e.output
-									})
-							}
-						})
-
-					# fetch the result
-					result = {}
-					if (pipe != None):
-						data = json.loads(pipe.replace('====================','',1))
-						if 'result' in data:
-							result = data['result']
-					
-					if 'insert_at_head_start' in result and is_valid_string(result['insert_at_head_start']):
-						insert_at_head_start.append(result['insert_at_head_start'].decode('string_escape'))
-
-					if 'insert_at_head_end' in result and is_valid_string(result['insert_at_head_end']):
-						insert_at_head_end.append(result['insert_at_head_end'].decode('string_escape'))
-
-					if 'insert_at_body_start' in result and is_valid_string(result['insert_at_body_start']):
-						insert_at_body_start.append(result['insert_at_body_start'].decode('string_escape'))
-
-					if 'insert_at_body_end' in result and is_valid_string(result['insert_at_body_end']):
-						insert_at_body_end.append(result['insert_at_body_end'].decode('string_escape'))
-
-					if 'insert_into_hype_document_load' in result and is_valid_string(result['insert_into_hype_document_load']):
-						insert_into_hype_document_load.append(result['insert_into_hype_document_load'].decode('string_escape'))
-
-					if 'insert_into_generated_script' in result and is_valid_string(result['insert_into_generated_script']):
-						insert_into_generated_script.append(result['insert_into_generated_script'].decode('string_escape'))
+		# results for supported bundle returns
+		insert_at_head_start = inserts['insert_at_head_start']
+		insert_at_head_end = inserts['insert_at_head_end']
+		insert_at_body_start = inserts['insert_at_body_start']
+		if bundle.args.is_preview:
+			insert_at_body_start.extend(notices)
+		insert_at_body_end = inserts['insert_at_body_end']
+		insert_into_hype_document_load = inserts['insert_into_hype_document_load']
+		insert_into_generated_script = inserts['insert_into_generated_script']
 
-					if 'patch_generated_script' in result and is_valid_string(result['patch_generated_script']):
-						patch_generated_script.append(result['patch_generated_script'])
+		# compile the patches of all bundles once to report conflicts, every
+		# generated script is then patched in one pass by the same patches
+		patcher = ScriptPatcher(patches)
 
 
 		# substitutions for hype_document_load
-		hype_document_load = template_variables(hype_document_load, {
+		document_load = template_variables(hype_document_load, {
 				'insert_into_hype_document_load'	:	"\n".join(insert_into_hype_document_load),
 				'hype_document_name'				:	hype_document_name,
 				'script_version'					:	script_version,
 			})
 
 		# substitutions for hype functions header
-		prepend_to_hype_functions = template_variables(prepend_to_hype_functions, {
+		functions_header = template_variables(prepend_to_hype_functions, {
 				'hype_document_name'	:	hype_document_name
 			})
 
-		# now modifiy generated script
+		# compile with closure on exports or previews if enabled, using a local
+		# compiler if configured (offline) else the Closure API
+		closure_cache = ClosureCache(os.path.join(bundle.cache_folder, 'Closure'))
+		closure = None
+		if bundle.variable_is_enabled('_closure_compiler_on_preview' if bundle.args.is_preview else '_closure_compiler_on_export'):
+			closure = {
+				'local' : bundle.get_variable('_closure_compiler_local'),
+				'cache_folder' : closure_cache.folder,
+			}
+
+		# now modifiy generated scripts, concurrently if there are several
+		generated_scripts = []
 		for path, dirs, files in os.walk(os.path.abspath(bundle.args.modify_staging_path)):
 			for filename in fnmatch.filter(files, '*_hype_generated_script.js'):
-				
-				# filepath and read
-				filepath = os.path.join(path, filename)
-				generated_script = read_content(filepath)
-				
-				# replace relative with absolute calls in generated script
-				generated_script = generated_script.replace(r'exportScriptOid:".*?\.hype-export\.py",', '')
-				generated_script = generated_script.replace('s:"hypeDocument.', 's:"HYPE.documents[\\"'+hype_document_name+'\\"].')
-				
-				# hype function regex with Friedl's "unrolled loop)
-				pattern = re.compile(r'name:"(.*?)",source:"([^"\\]*(?:\\.[^"\\]*)*)"')
-				signature = "function(hypeDocument, element, event) {"
-				
-				# unpack hype functions
-				hype_functions = ''
-				for m in re.finditer(pattern, generated_script):
-					new_name = 'HYPE_functions[\\"'+hype_document_name+'\\"].'+m.group(1)
-					generated_script = generated_script.replace(m.group(2), new_name)
-					new_name_decoded = new_name.decode('string_escape')
-					function_raw = m.group(2).replace(signature, signature+"\n");
-					function_decoded = function_raw.decode('string_escape')
-					hype_functions = hype_functions+"\n"+new_name_decoded+" = "+function_decoded+";\n"
-					hype_functions += '//'+m.group(2)+"\n"
-				
-				# add javascript for actions and hype functions
-				script_additions = prepend_to_hype_functions+"\n"+hype_functions+"\n"+hype_document_load
-
-				# add further addition from the bundles
-				if len(insert_into_generated_script):
-					script_additions += "\n".join(insert_into_generated_script)					
-
-				# use closure API on exports if enabled
-				if not bundle.args.is_preview and bundle.variable_is_enabled('_closure_compiler_on_export'):
-					script_additions, js_errors, js_warnings = compile_with_closure(script_additions, os.path.join(bundle.cache_folder, 'Closure'))
-
-				# use closure API on previews if enabled
-				if bundle.args.is_preview and bundle.variable_is_enabled('_closure_compiler_on_preview'):
-					script_additions, js_errors, js_warnings = compile_with_closure(script_additions, os.path.join(bundle.cache_folder, 'Closure'))
-					if js_errors:
-						insert_at_body_start.append(template_variables(closure_error, { 'closure_error' : js_errors }))
-					if js_warnings and bundle.variable_is_enabled('_closure_compiler_warnings'):
-						insert_at_body_start.append(template_variables(closure_warning, { 'closure_warning' :  js_warnings }))
-
-				# append script
-				generated_script = script_additions+"\n"+generated_script;
-
-				#save
-				save_content(filepath, generated_script)
+				generated_scripts.append(os.path.join(path, filename))
+
+		with trace.span('generated scripts'):
+			reports = rewrite_generated_scripts(generated_scripts, hype_document_name, {
+				'functions_header' : functions_header,
+				'document_load' : document_load,
+				'insert_into_generated_script' : insert_into_generated_script,
+				'closure' : closure,
+				'patches' : patches,
+			}, bundle.get_variable_as_int('_scripts_max_workers', 4))
+
+		for report in reports:
+			closure_cache.hits += report['hits']
+			closure_cache.misses += report['misses']
+			patcher.add_counts(report['patch_counts'], report['patch_shadowed'])
+
+			# show feedback on previews in script order
+			if bundle.args.is_preview:
+				if report['errors']:
+					insert_at_body_start.append(template_variables(closure_error, { 'closure_error' : report['errors'] }))
+				if report['warnings'] and bundle.variable_is_enabled('_closure_compiler_warnings'):
+					insert_at_body_start.append(template_variables(closure_warning, { 'closure_warning' :  report['warnings'] }))
 		
+		# report patch conflicts and patches that didn't apply to any generated script
+		if generated_scripts:
+			for problem in patcher.problems + patcher.conflicts() + patcher.unapplied():
+				bundle.log(problem, level='warning')
+				if bundle.args.is_preview:
+					insert_at_body_start.append(template_variables(subprocess_error, { 'subprocess_error': problem }))
+
+		# keep track of the closure cache
+		if closure_cache.hits or closure_cache.misses:
+			stats = closure_cache.save_stats()
+			bundle.log('Closure cache: {hits} hits, {misses} misses ({total_hits} hits, {total_misses} misses in total)'.format(**stats))
+
 		# pull in debugger resources if enabled and preview
 		if acme_debugger and bundle.args.is_preview:
-			shutil.copy(os.path.join(bundle.folder, 'acme_debugger.css'), bundle.args.modify_staging_path)
-			shutil.copy(os.path.join(bundle.folder, 'acme_debugger.js'), bundle.args.modify_staging_path)
+			bundle.provide_assets([
+				{ 'path' : os.path.join(bundle.folder, 'acme_debugger.css') },
+				{ 'path' : os.path.join(bundle.folder, 'acme_debugger.js') },
+			])
 			insert_at_head_end.append('<link rel="stylesheet" href="acme_debugger.css" />')
 			insert_at_head_end.append('<script src="acme_debugger.js" type="text/javascript"></script>')
 			if not bundle.variable_is_enabled('_disable_javascript_errors'):
 				insert_at_head_end.append(javascript_error)
+			# phases up to now and the slowest bundles
+			if bundle.variable_is_enabled('_export_profile_overlay'):
+				insert_at_body_end.append(template_variables(export_profile, { 'export_profile' : trace.overlay_data() }))
 
 
-		# load index html template
+		# perform accumulated substitutions in one pass over the index html
 		index_path = os.path.join(bundle.args.modify_staging_path, bundle.export_info['html_filename'].encode("utf-8"))
-		index_contents = read_content(index_path)
-		
-		# perform accumulated substitutions 
-		if len(insert_at_head_start):
-			index_contents = insert_at_start("<head.*?>", index_contents, "\n".join(insert_at_head_start))
-		
-		if len(insert_at_head_end):
-			index_contents = insert_at_end("</head", index_contents, "\n".join(insert_at_head_end)) 
-		
-		if len(insert_at_body_start):
-			index_contents = insert_at_start("<body.*?>", index_contents, "\n".join(insert_at_body_start))
-		
-		if len(insert_at_body_end):
-			index_contents = insert_at_end("</body", index_contents, "\n".join(insert_at_body_end))			
-
-		# save results
-		save_content(index_path, index_contents)
+		with trace.span('html'):
+			inject_html_file(index_path, {
+				'insert_at_head_start' : insert_at_head_start,
+				'insert_at_head_end' : insert_at_head_end,
+				'insert_at_body_start' : insert_at_body_start,
+				'insert_at_body_end' : insert_at_body_end,
+			})
 
-		# push to final destination
+		# push to final destination, renaming into place and deleting the old
+		# destination in the background (copying only changed files across volumes)
 		# TBD introduce export bundles that can take over this step, single plugin set by user
-		shutil.rmtree(bundle.args.destination_path, ignore_errors=True)
-		shutil.move(bundle.args.modify_staging_path, bundle.args.destination_path)
+		with trace.span('finalize'):
+			finalize_export(bundle.args.modify_staging_path, bundle.args.destination_path, os.path.join(bundle.cache_folder, 'Trash'))
+
+		# write the timing report (and the profile if enabled) to the logs
+		trace.stop_profiler(os.path.join(bundle.logs_folder, 'ExportProfile.prof'))
+		trace.save(os.path.join(bundle.logs_folder, 'ExportProfile.json'),
+			document = hype_document_name,
+			is_preview = bundle.args.is_preview,
+			bundles = len(bundle_files),
+			generated_scripts = len(generated_scripts),
+		)
+
+		# keep a worker around for the next preview if enabled
+		if bundle.variable_is_enabled('_background_worker'):
+			start_worker(__file__)
+		else:
+			stop_worker()
 
 		# let Hype know that we are done
 		bundle.exit_with_result(True)
@@ -386,31 +555,23 @@ javascript_error= """
 <script>window.onerror = showJavaScriptError;</script>
 """
 
+export_profile= """
+<script>showExportProfile(${export_profile});</script>
+"""
+
 
 if __name__ == "__main__":
 
 	# log errors to bundle
 	sock = open(os.path.dirname(__file__)+'/errors.log', 'a')
 	sys.stderr = sock
-	
-	# append bundle import path to sys path and mount HypeBundle class
-	sys.path.append(os.path.join(os.path.dirname(__file__), 'import/'))
-
-	from hypebundle import *
-	from closurecompiler import *
-
-	# functions
-	def insert_at_start(pattern, string, insert):
-		temp = re.search(pattern, string, re.IGNORECASE).end()
-		return string[:temp] + insert + string[temp:]
-
-	def insert_at_end(pattern, string, insert):
-		temp = re.search(pattern, string, re.IGNORECASE).start()
-		return string[:temp] + insert + string[temp:]
 
-	def is_valid_string(value):
-		# basestring in 2.7 else str
-		return isinstance(value, basestring) and value.strip()
+	# hand previews and exports to the background worker if one is running
+	if '--modify_staging_path' in sys.argv:
+		response = forward_to_worker(sys.argv[1:])
+		if response != None:
+			sys.stdout.write(response['output'])
+			sys.exit(response['status'])
 
 	# ready so run main
 	main()
@@ -28,6 +28,7 @@ const Toast = Swal.mixin({
 
 const footer_closure = 'Learn more about the&nbsp;<a target="_blank" href="https://developers.google.com/closure/compiler">Google Closure Compiler</a>.';
 const footer_onerror = 'Open your developer console to see more details about the error.';
+const footer_profile = 'The full report is written to ExportProfile.json in the AdvancedCapabilities Logs folder.';
 
 function showClosureCompilerWarning(msg){
 	var plural = msg.split('JSC_').length> 2 ? 's' : '';
@@ -133,3 +134,29 @@ function showJavaScriptError(message, source, lineno, colno, error) {
 };
 
 
+function showExportProfile(profile){
+	// profile is {total, phases, bundles} with [name, ms] pairs from the manager
+	var rows = function(list){
+		return list.map(function(item){
+			return `${item[1]+'ms'}`.padStart(8)+'  '+item[0];
+		}).join('\n');
+	}
+	var slowest = profile.phases.concat(profile.bundles).sort(function(a, b){ return b[1]-a[1]; })[0];
+	Toast.fire({
+		icon: 'info',
+		title: 'Export took '+profile.total+'ms'+(slowest ? ' ('+slowest[0]+' '+slowest[1]+'ms)' : ''),
+	}).then((result) => {
+		if (result.isConfirmed) {
+			Swal.fire({
+				icon: 'info',
+				html: `<pre><code>Phases\n${rows(profile.phases)}\n\nSlowest bundles\n${rows(profile.bundles) || '     none'}</code></pre>`, 
+				title: 'Export profile',
+				customClass: {
+					container: 'alert-container',
+				},
+				footer: footer_profile,
+			})
+		}
+	})
+}
+
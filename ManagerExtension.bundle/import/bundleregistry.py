@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# 	bundleregistry.py
+#	Index of installed bundles for the manager
+#
+#	 v1.0.0 Initial release
+#	 v1.0.1 permission fixes without shelling out
+#	 v1.0.2 capabilities declared by bundles in --get_options
+#	 v1.0.3 modes refreshed on every scan
+#
+#
+#	MIT License
+#	Copyright (c) 2021 Max Ziebell
+#
+
+import os
+import re
+import stat as stat_module
+import json
+import fnmatch
+import tempfile
+
+from bundlerunner import run_bundle, encode_strings
+
+
+# bundles accepting a prepared bundle in main(bundle=None) can run in-process
+in_process_pattern = re.compile(r'^def main\(\s*[A-Za-z_]', re.MULTILINE)
+
+# manifests of other versions are dropped (entries lack newer details)
+manifest_version = 2
+
+# seconds a bundle gets to answer --get_options when it changed
+get_options_timeout = 10
+
+
+
+class BundleRegistry:
+
+	'''
+	Constructor and basics
+	'''
+
+	def __init__(self, bundles_folder, manifest_path):
+		# the manifest remembers the listing of every folder and the details of every
+		# bundle so later calls only list folders and read bundles that changed
+		self.bundles_folder = bundles_folder
+		self.manifest_path = manifest_path
+		self._bundles = None
+
+
+	def bundles(self):
+		# installed bundles in walk order (refreshed once per instance)
+		if self._bundles == None:
+			self.refresh()
+		return self._bundles
+
+
+	def get(self, filepath):
+		# bundle entry by filepath or None
+		self.bundles()
+		return self._bundles_by_path.get(filepath)
+
+
+	def fix_permissions(self, mode=0755):
+		# make sure all bundles can be run, only touching bundles whose
+		# mode (as of the last scan) lacks the permission bits
+		changed = False
+		for entry in self.bundles():
+			if stat_module.S_IMODE(entry['mode']) & mode != mode:
+				try:
+					os.chmod(entry['path'], stat_module.S_IMODE(entry['mode']) | mode)
+					entry['mode'] = os.stat(entry['path']).st_mode
+					changed = True
+				except OSError:
+					pass
+		if changed:
+			self._save_manifest({
+				'version' : manifest_version,
+				'folders' : self._folders,
+				'bundles' : self._bundles_by_path,
+			})
+		return changed
+
+
+	'''
+	Scanning
+	'''
+
+	def refresh(self):
+		# walk the bundles folder like os.walk (top down, not following links)
+		# reusing folder listings and bundle entries whose mtime didn't change
+		manifest = self._load_manifest()
+		self._changed = False
+		self._old_folders = manifest.get('folders', {})
+		self._old_bundles = manifest.get('bundles', {})
+		self._folders = {}
+		self._bundles = []
+		self._bundles_by_path = {}
+
+		if os.path.isdir(self.bundles_folder):
+			self._scan(self.bundles_folder)
+
+		# folders or bundles that are gone also change the manifest
+		if len(self._folders) != len(self._old_folders) or len(self._bundles) != len(self._old_bundles):
+			self._changed = True
+
+		if self._changed:
+			self._save_manifest({
+				'version' : manifest_version,
+				'folders' : self._folders,
+				'bundles' : self._bundles_by_path,
+			})
+		return self._bundles
+
+
+	def _scan(self, path):
+		try:
+			mtime = os.stat(path).st_mtime
+		except OSError:
+			return
+
+		# list folder only if it changed since the last scan
+		listing = self._old_folders.get(path)
+		if listing == None or listing['mtime'] != mtime:
+			listing = self._list_folder(path, mtime)
+			self._changed = True
+		self._folders[path] = listing
+
+		for filename in fnmatch.filter(listing['files'], '*.hype-export.py'):
+			self._register(os.path.join(path, filename))
+
+		for name in listing['dirs']:
+			self._scan(os.path.join(path, name))
+
+
+	def _list_folder(self, path, mtime):
+		dirs = []
+		files = []
+		try:
+			names = os.listdir(path)
+		except OSError:
+			names = []
+		for name in names:
+			fullpath = os.path.join(path, name)
+			if os.path.isdir(fullpath):
+				if not os.path.islink(fullpath):
+					dirs.append(name)
+			else:
+				files.append(name)
+		return { 'mtime' : mtime, 'dirs' : dirs, 'files' : files }
+
+
+	def _register(self, filepath):
+		try:
+			stat = os.stat(filepath)
+		except OSError:
+			return
+
+		# reuse the entry if the bundle didn't change
+		entry = self._old_bundles.get(filepath)
+		if entry == None or entry['mtime'] != stat.st_mtime:
+			entry = self._describe(filepath, stat)
+			self._changed = True
+		elif entry['mode'] != stat.st_mode:
+			# chmod doesn't touch mtime, fix_permissions needs the current mode
+			entry['mode'] = stat.st_mode
+			self._changed = True
+		self._bundles.append(entry)
+		self._bundles_by_path[filepath] = entry
+
+
+	def _describe(self, filepath, stat):
+		# details and declared capabilities of a bundle
+		filename = os.path.basename(filepath)
+		try:
+			with open(filepath, 'r') as f:
+				source = f.read()
+		except IOError:
+			source = ''
+		declared = fetch_declared_capabilities(filepath)
+		return {
+			'path' : filepath,
+			'filename' : filename,
+			'label' : filename.replace('.hype-export.py',''),
+			'identifier' : '_bundle_'+filename.replace('.hype-export.py',''),
+			'mtime' : stat.st_mtime,
+			'mode' : stat.st_mode,
+			'capabilities' : {
+				'in_process' : bool(in_process_pattern.search(source)),
+				'insert_points' : declared.get('insert_points'), # None means any
+				'depends_on' : declared.get('depends_on') or [],
+				'deterministic' : declared.get('deterministic'), # None means unknown
+			},
+		}
+
+
+	'''
+	Manifest
+	'''
+
+	def _load_manifest(self):
+		try:
+			with open(self.manifest_path, 'r') as f:
+				manifest = encode_strings(json.load(f))
+		except (IOError, OSError, ValueError):
+			return {}
+		if manifest.get('version') != manifest_version:
+			return {}
+		return manifest
+
+
+	def _save_manifest(self, manifest):
+		# write atomically, a failing write only costs a full scan next time
+		try:
+			folder = os.path.dirname(self.manifest_path)
+			if not os.path.isdir(folder):
+				os.makedirs(folder)
+			handle, temp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+			with os.fdopen(handle, 'w') as f:
+				json.dump(manifest, f)
+			os.rename(temp_path, self.manifest_path)
+		except (IOError, OSError):
+			pass
+
+
+
+def fetch_declared_capabilities(filepath):
+	# capabilities a bundle returns with --get_options, empty if it declares none
+	try:
+		result = run_bundle(filepath, ['--get_options'], get_options_timeout)
+	except Exception:
+		return {}
+	if isinstance(result, dict) and isinstance(result.get('capabilities'), dict):
+		return encode_strings(result['capabilities'])
+	return {}
@@ -0,0 +1,652 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# 	bundlerunner.py
+#	Helper classes and functions to run bundles from the manager
+#
+#	 v1.0.0 Initial release, concurrent bundle executor
+#	 v1.0.1 in-process bundle execution
+#	 v1.0.2 persistent bundle result cache
+#	 v1.0.3 run bundles without a shell
+#	 v1.0.4 framed result channel, bundle output kept apart from results
+#	 v1.0.5 bundle timeouts, duration history and circuit breaker
+#	 v1.0.6 dependency levels and declared insert points
+#	 v1.0.7 keep patch lists when collecting results
+#	 v1.0.8 capture output of in-process bundles
+#	 v1.0.9 cached results as utf-8 strings like fresh ones
+#	 v1.0.10 join cancelled timeout timers
+#
+#
+#	MIT License
+#	Copyright (c) 2021 Max Ziebell
+#
+
+import sys
+import os
+import imp
+import json
+import hashlib
+import inspect
+import argparse
+import threading
+import subprocess
+import Queue
+import tempfile
+import fcntl
+import signal
+import time
+import StringIO
+import contextlib
+
+import hypebundle
+from hypebundle import HypeBundle, BundleExit, RESULT_FD_VARIABLE, read_result_frames
+
+
+# bundle modules loaded for in-process runs by filepath (mtime, module)
+_bundle_modules = {}
+_bundle_modules_lock = threading.Lock()
+
+# interpreter used for bundle subprocesses
+python_executable = sys.executable or 'python'
+
+# held while replacing sys.stdout and sys.stderr with a ThreadOutput
+_output_lock = threading.Lock()
+
+# held while creating a result pipe and spawning its bundle so concurrent
+# bundles never inherit each other's pipe
+_spawn_lock = threading.Lock()
+
+# insert points a bundle can return (in the order the manager applies them)
+INSERT_KEYS = [
+	'insert_at_head_start',
+	'insert_at_head_end',
+	'insert_at_body_start',
+	'insert_at_body_end',
+	'insert_into_hype_document_load',
+	'insert_into_generated_script',
+	'patch_generated_script',
+]
+
+
+
+class BundleExecutor:
+
+	'''
+	Constructor and basics
+	'''
+
+	def __init__(self, max_workers=4):
+		# cap the amount of bundles running at the same time
+		self.max_workers = max(1, int(max_workers))
+
+
+	def map(self, function, items):
+		# run function for each item on a bounded pool of worker threads
+		# and return the results in the order of the given items
+		items = list(items)
+
+		# nothing to gain from threads so keep it simple
+		if self.max_workers == 1 or len(items) < 2:
+			return [function(item) for item in items]
+
+		results = [None] * len(items)
+		errors = [None] * len(items)
+
+		jobs = Queue.Queue()
+		for index, item in enumerate(items):
+			jobs.put((index, item))
+
+		def worker():
+			while True:
+				try:
+					index, item = jobs.get_nowait()
+				except Queue.Empty:
+					return
+				try:
+					results[index] = function(item)
+				except Exception:
+					errors[index] = sys.exc_info()
+
+		threads = [threading.Thread(target=worker) for i in range(min(self.max_workers, len(items)))]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		# raise the first error in item order to stay deterministic
+		for error in errors:
+			if error:
+				raise error[0], error[1], error[2]
+
+		return results
+
+
+
+class BundleResultCache:
+
+	'''
+	Constructor and basics
+	'''
+
+	def __init__(self, folder, max_size=10*1024*1024):
+		# store results as one JSON file per key and cap the folder size in bytes
+		self.folder = folder
+		self.max_size = max_size
+		if not os.path.isdir(self.folder):
+			os.makedirs(self.folder)
+
+
+	def key(self, filepath, export_info, args):
+		# everything that can change the result of a bundle run: the bundle source,
+		# the files next to it in its .bundle folder (templates, data), its document
+		# arguments, preview vs export, Hype build, document name and the
+		# hypebundle library itself
+		file_name = os.path.basename(filepath)
+		document_arguments = export_info.get('all_document_arguments_by_export_script', {}).get(file_name, {})
+
+		digest = hashlib.sha1()
+		digest.update(read_binary(filepath))
+		digest.update(json.dumps(_bundle_folder_stamps(filepath)))
+		digest.update(_library_digest())
+		digest.update(json.dumps(document_arguments, sort_keys=True))
+		digest.update(json.dumps([
+			bool(args.is_preview),
+			args.hype_build,
+			os.path.basename(os.path.normpath(args.modify_staging_path)),
+		]))
+		return digest.hexdigest()
+
+
+	'''
+	Lookup and store
+	'''
+
+	def get(self, key):
+		# return cached result or None on a miss (or if a declared file changed)
+		entry_path = os.path.join(self.folder, key+'.json')
+		try:
+			with open(entry_path, 'r') as f:
+				entry = json.load(f)
+		except Exception:
+			return None
+
+		for path, stamp in entry.get('files', {}).items():
+			if _file_stamp(path) != stamp:
+				return None
+
+		# touch entry for least recently used eviction
+		try:
+			os.utime(entry_path, None)
+		except OSError:
+			pass
+		return encode_strings(entry['result'])
+
+
+	def set(self, key, result):
+		# store result unless the bundle opted out with 'cache' : False
+		# bundles can add files to the key with 'cache' : {'files' : [...]}
+		if not isinstance(result, dict):
+			return False
+		options = result.get('cache', True)
+		if options is False:
+			return False
+
+		files = options.get('files', []) if isinstance(options, dict) else []
+		entry = {
+			'result' : result,
+			'files' : dict((path, _file_stamp(path)) for path in files),
+		}
+
+		# write atomically so concurrent exports never read half an entry
+		handle, temp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+		with os.fdopen(handle, 'w') as f:
+			json.dump(entry, f)
+		os.rename(temp_path, os.path.join(self.folder, key+'.json'))
+
+		self.evict()
+		return True
+
+
+	def evict(self):
+		# remove least recently used entries until we are below max_size
+		entries = []
+		total = 0
+		for filename in os.listdir(self.folder):
+			if not filename.endswith('.json'):
+				continue
+			path = os.path.join(self.folder, filename)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, path))
+			total += stat.st_size
+
+		for mtime, size, path in sorted(entries):
+			if total <= self.max_size:
+				break
+			try:
+				os.remove(path)
+				total -= size
+			except OSError:
+				pass
+
+
+
+class BundleTimeout(Exception):
+	# raised by run_bundle if a bundle was stopped after running too long
+	def __init__(self, filepath, timeout, output):
+		Exception.__init__(self, '{} timed out after {}s'.format(filepath, timeout))
+		self.filepath = filepath
+		self.timeout = timeout
+		self.output = output
+
+
+
+class BundleHealth:
+	# how long bundles ran and how often they failed in a row. After
+	# max_failures failures or timeouts in a row a bundle is skipped for
+	# cooldown seconds, then tried once again (success closes the circuit)
+
+	'''
+	Constructor and basics
+	'''
+
+	def __init__(self, filepath, max_failures=3, cooldown=600, history=20):
+		self.filepath = filepath
+		self.max_failures = max_failures
+		self.cooldown = cooldown
+		self.history = history
+		self._lock = threading.Lock()
+		try:
+			with open(self.filepath, 'r') as f:
+				self.bundles = json.load(f)
+		except (IOError, OSError, ValueError):
+			self.bundles = {}
+
+
+	def _entry(self, path):
+		return self.bundles.setdefault(path, { 'durations' : [], 'failures' : 0, 'timeouts' : 0, 'open_until' : 0 })
+
+
+	'''
+	Circuit breaker
+	'''
+
+	def allow(self, path):
+		# False while the circuit of a bundle is open
+		with self._lock:
+			return time.time() >= self._entry(path)['open_until']
+
+
+	def record(self, path, duration, outcome):
+		# outcome is 'success', 'failure' or 'timeout', returns the entry
+		with self._lock:
+			entry = self._entry(path)
+			entry['durations'] = (entry['durations'] + [round(duration, 4)])[-self.history:]
+			if outcome == 'success':
+				entry['failures'] = entry['timeouts'] = 0
+				entry['open_until'] = 0
+			else:
+				entry['failures'] += 1
+				if outcome == 'timeout':
+					entry['timeouts'] += 1
+				if entry['failures'] >= self.max_failures:
+					entry['open_until'] = time.time() + self.cooldown
+			return dict(entry)
+
+
+	def average(self, path):
+		durations = self.bundles.get(path, {}).get('durations')
+		return sum(durations)/len(durations) if durations else None
+
+
+	def save(self):
+		# write atomically, a failing write only loses this run
+		try:
+			folder = os.path.dirname(self.filepath)
+			if not os.path.isdir(folder):
+				os.makedirs(folder)
+			handle, temp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+			with os.fdopen(handle, 'w') as f:
+				json.dump(self.bundles, f)
+			os.rename(temp_path, self.filepath)
+		except (IOError, OSError):
+			pass
+
+
+
+'''
+Run bundles (subprocess)
+'''
+
+def run_bundle(filepath, bundle_args, timeout=None):
+	# run bundle in its own Python process and return its result dict
+	# executing the interpreter directly (no shell, no quoting) with the
+	# argument vector prepared once by the manager. The result arrives in frames
+	# over a pipe while stdout and stderr only carry the bundle's own output.
+	# A bundle (and what it started) running longer than timeout seconds is
+	# killed and BundleTimeout raised
+	argv = [python_executable, filepath]
+	argv.extend(bundle_args)
+
+	with tempfile.TemporaryFile() as output:
+		with _spawn_lock:
+			read_fd, write_fd = os.pipe()
+			_set_inheritable(read_fd, False)
+			_set_inheritable(write_fd, False)
+			env = dict(os.environ)
+			env[RESULT_FD_VARIABLE] = str(write_fd)
+
+			def prepare_child():
+				# own process group so a timeout can kill everything the bundle started
+				_set_inheritable(write_fd, True)
+				os.setpgrp()
+
+			try:
+				process = subprocess.Popen(argv, stdout=output, stderr=output, env=env,
+					close_fds=False, preexec_fn=prepare_child)
+			finally:
+				os.close(write_fd)
+
+		timed_out = []
+		timer = None
+		if timeout:
+			def kill():
+				timed_out.append(True)
+				try:
+					os.killpg(process.pid, signal.SIGKILL)
+				except OSError:
+					pass
+			timer = threading.Timer(timeout, kill)
+			timer.daemon = True
+			timer.start()
+
+		try:
+			with os.fdopen(read_fd, 'rb') as channel:
+				result = result_from_frames(read_result_frames(channel))
+		except Exception:
+			# frames cut short by the kill
+			if not timed_out:
+				raise
+		finally:
+			returncode = process.wait()
+			if timer:
+				# a timer left waiting breaks at interpreter shutdown
+				timer.cancel()
+				timer.join()
+
+		output.seek(0)
+		log = output.read()
+
+	if timed_out:
+		raise BundleTimeout(filepath, timeout, log)
+
+	if returncode:
+		raise subprocess.CalledProcessError(returncode, argv, output=log)
+
+	# bundles printing their result themselves still use the banner on stdout
+	if result == None:
+		return parse_bundle_output(log[log.find('===================='):] if '====================' in log else None)
+	return result
+
+
+def result_from_frames(frames):
+	# assemble the result dict from its frames, None if there were none
+	result = None
+	for kind, name, payload in frames:
+		if result == None:
+			result = {}
+		if kind == 'insert':
+			result[name] = payload
+		elif kind == 'patch':
+			result[name] = json.loads(payload)
+		elif kind == 'result':
+			value = json.loads(payload)
+			if isinstance(value, dict):
+				result.update(value)
+			else:
+				result = value
+	return result
+
+
+def _set_inheritable(fd, inheritable):
+	flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+	if inheritable:
+		fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+	else:
+		fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def run_bundle_in_process(filepath, args, export_info):
+	# run bundle as module in this process and return its result dict
+	# returns None if the bundle doesn't support it (use run_bundle instead)
+	module = load_bundle_module(filepath)
+	if not supports_in_process(module):
+		return None
+
+	# every bundle gets its own copy of the arguments
+	bundle_args = argparse.Namespace(**vars(args))
+	bundle_args.get_inserts = True
+	bundle_args.get_options = False
+	bundle_args.check_for_updates = False
+
+	# what the bundle prints must not end up in the answer of the manager
+	# to Hype, it goes to the log of the bundle instead
+	context = None
+	with _captured_output() as output:
+		try:
+			context = HypeBundle({
+				'file' : filepath,
+				'args' : bundle_args,
+				'export_info' : export_info,
+				'in_process' : True,
+			})
+			module.main(context)
+			result = {}
+		except BundleExit as e:
+			result = e.result
+		except SystemExit:
+			# bundle bailed out before returning a result
+			result = None
+
+	if context and output.getvalue().strip():
+		context.log(output.getvalue())
+		context.flush_log()
+	return result
+
+
+class ThreadOutput:
+	# stand-in for sys.stdout and sys.stderr that sends what threads running
+	# an in-process bundle write to the buffer of that bundle and everything
+	# else to the stream it replaced
+	def __init__(self, stream):
+		self.stream = stream
+		self.buffers = {}
+
+	def write(self, data):
+		self.buffers.get(threading.current_thread().ident, self.stream).write(data)
+
+	def writelines(self, lines):
+		for line in lines:
+			self.write(line)
+
+	def flush(self):
+		self.stream.flush()
+
+	def __getattr__(self, name):
+		return getattr(self.stream, name)
+
+
+@contextlib.contextmanager
+def _captured_output():
+	# buffer what the calling thread writes to stdout and stderr
+	with _output_lock:
+		for name in ['stdout', 'stderr']:
+			if not isinstance(getattr(sys, name), ThreadOutput):
+				setattr(sys, name, ThreadOutput(getattr(sys, name)))
+		streams = [sys.stdout, sys.stderr]
+	output = StringIO.StringIO()
+	ident = threading.current_thread().ident
+	for stream in streams:
+		stream.buffers[ident] = output
+	try:
+		yield output
+	finally:
+		for stream in streams:
+			stream.buffers.pop(ident, None)
+
+
+def supports_in_process(module):
+	# bundles opt in by accepting a prepared bundle in main(bundle=None)
+	main = getattr(module, 'main', None)
+	return callable(main) and len(inspect.getargspec(main).args) > 0
+
+
+def load_bundle_module(filepath):
+	# load bundle as module (once per modification) without writing bytecode
+	# next to it, mounting hypebundle like the bundle would in __main__
+	mtime = os.path.getmtime(filepath)
+	with _bundle_modules_lock:
+		cached = _bundle_modules.get(filepath)
+		if cached and cached[0] == mtime:
+			return cached[1]
+
+		module = imp.new_module('hypebundle_'+hashlib.md5(filepath).hexdigest())
+		module.__file__ = filepath
+		exec 'from hypebundle import *' in module.__dict__
+		with open(filepath, 'r') as f:
+			code = compile(f.read(), filepath, 'exec')
+		exec code in module.__dict__
+
+		_bundle_modules[filepath] = (mtime, module)
+		return module
+
+
+def parse_bundle_output(pipe):
+	# fetch the result from the output of exit_with_result
+	result = {}
+	if (pipe != None):
+		data = json.loads(pipe.replace('====================','',1))
+		if 'result' in data:
+			result = data['result']
+	return result
+
+
+
+'''
+Schedule bundles
+'''
+
+def dependency_levels(entries):
+	# group registry entries into levels that run one after another, every bundle
+	# comes after the bundles it depends on (by label). Bundles within a level are
+	# independent and keep walk order. Returns the levels and a list of problems
+	# (dependencies that aren't enabled and cycles, which run in walk order)
+	problems = []
+	labels = set(entry['label'] for entry in entries)
+	dependencies = {}
+	for entry in entries:
+		dependencies[entry['path']] = set()
+		for label in entry['capabilities'].get('depends_on') or []:
+			if label in labels and label != entry['label']:
+				dependencies[entry['path']].add(label)
+			else:
+				problems.append('{} depends on {} which is not enabled'.format(entry['label'], label))
+
+	levels = []
+	done = set()
+	remaining = list(entries)
+	while remaining:
+		level = [entry for entry in remaining if dependencies[entry['path']] <= done]
+		if not level:
+			problems.append('circular dependencies between ' + ', '.join(entry['label'] for entry in remaining))
+			level = remaining
+		levels.append(level)
+		done.update(entry['label'] for entry in level)
+		remaining = [entry for entry in remaining if entry not in level]
+	return levels, problems
+
+
+def restrict_result(result, insert_points):
+	# drop insert points a bundle didn't declare (None means it declared none)
+	if insert_points == None or not isinstance(result, dict):
+		return result
+	return dict((key, value) for key, value in result.items() if key not in INSERT_KEYS or key in insert_points)
+
+
+
+'''
+Collect results
+'''
+
+def collect_inserts(results):
+	# merge bundle results into lists per insert point keeping the given order
+	inserts = dict((key, []) for key in INSERT_KEYS)
+	for result in results:
+		if not isinstance(result, dict):
+			continue
+		for key in INSERT_KEYS:
+			if key == 'patch_generated_script':
+				# patches are a list of dicts (or a single dict), see scriptpatcher
+				if isinstance(result.get(key), (list, dict)) and result[key]:
+					inserts[key].append(result[key])
+			elif key in result and is_valid_string(result[key]):
+				inserts[key].append(encode_strings(result[key]).decode('string_escape'))
+	return inserts
+
+
+def read_binary(filepath):
+	with open(filepath, 'rb') as f:
+		return f.read()
+
+
+def _file_stamp(path):
+	# size and modification time of a file or None if it is missing
+	try:
+		stat = os.stat(path)
+		return [stat.st_size, stat.st_mtime]
+	except OSError:
+		return None
+
+
+def _bundle_folder_stamps(filepath):
+	# relative path, size and modification time of every file in the .bundle
+	# folder of a bundle (empty for bundles that are not in a .bundle folder)
+	folder = os.path.dirname(os.path.abspath(filepath))
+	if not folder.endswith('.bundle'):
+		return []
+	stamps = []
+	for path, dirs, files in os.walk(folder):
+		dirs.sort()
+		for filename in sorted(files):
+			if filename.endswith('.pyc') or filename.startswith('.'):
+				continue
+			file_path = os.path.join(path, filename)
+			stamps.append([os.path.relpath(file_path, folder), _file_stamp(file_path)])
+	return stamps
+
+
+_library_digest_value = []
+def _library_digest():
+	# hash of the hypebundle source (computed once per run)
+	if not _library_digest_value:
+		_library_digest_value.append(hashlib.sha1(read_binary(os.path.splitext(hypebundle.__file__)[0]+'.py')).hexdigest())
+	return _library_digest_value[0]
+
+
+def encode_strings(value):
+	# json returns unicode, inserts and paths are utf-8 encoded strings everywhere else
+	if isinstance(value, dict):
+		return dict((encode_strings(key), encode_strings(item)) for key, item in value.items())
+	if isinstance(value, list):
+		return [encode_strings(item) for item in value]
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+
+def is_valid_string(value):
+	# basestring in 2.7 else str
+	return isinstance(value, basestring) and value.strip()
@@ -0,0 +1,295 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# 	bundleworker.py
+#	Optional long-lived worker that keeps the manager, its libraries and
+#	in-process bundles loaded between previews. The manager forwards
+#	--modify_staging_path requests over a Unix socket and falls back to
+#	running them itself if no worker is listening.
+#
+#	 v1.0.0 Initial release
+#	 v1.0.1 client timeout, fall back if the worker closes without an answer
+#	 v1.0.2 accept handshake, no fallback once accepted, stop stuck workers
+#
+#	Usage: python bundleworker.py --serve '<manager file>' [--idle_timeout 900]
+#
+#
+#	MIT License
+#	Copyright (c) 2021 Max Ziebell
+#
+
+import sys
+import os
+import imp
+import glob
+import json
+import signal
+import socket
+import argparse
+import tempfile
+import traceback
+import subprocess
+import StringIO
+
+
+# seconds the manager waits for the worker to accept a request before it
+# runs the request itself (the worker may be busy with another one)
+accept_timeout = 2
+
+# seconds the manager waits for the answer to an accepted request before it
+# stops the worker (bundle timeouts keep a healthy worker well below this)
+request_timeout = 300
+
+# state of this process (only set inside the worker)
+_running = False
+_shutdown_requested = False
+
+
+
+class BundleWorker:
+
+	'''
+	Constructor and basics
+	'''
+
+	def __init__(self, manager_file, idle_timeout=900):
+		self.manager_file = os.path.abspath(manager_file)
+		self.idle_timeout = idle_timeout
+		self.import_folder = os.path.dirname(os.path.abspath(__file__))
+
+
+	def serve(self):
+		# answer requests until idle for idle_timeout seconds, asked to shut down
+		# or the manager or one of its libraries changed (a fresh worker picks it up)
+		global _running
+		_running = True
+
+		path = socket_path()
+		if os.path.exists(path):
+			os.remove(path)
+
+		old_umask = os.umask(0077)
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind(path)
+		os.umask(old_umask)
+		server.listen(5)
+		server.settimeout(self.idle_timeout)
+
+		self.stamps = self._stamps()
+		self.manager = self._load_manager()
+
+		try:
+			while not _shutdown_requested:
+				try:
+					connection, address = server.accept()
+				except socket.timeout:
+					break
+				try:
+					self._handle(connection)
+				except Exception:
+					traceback.print_exc()
+				finally:
+					connection.close()
+		finally:
+			server.close()
+			if os.path.exists(path):
+				os.remove(path)
+
+
+	'''
+	Requests
+	'''
+
+	def _handle(self, connection):
+		# requests and answers are JSON lines: the client sends its request, we
+		# answer accepted (or declined), the client confirms with go and only
+		# then we run it. A client that gave up waiting runs the request itself
+		# and is gone by then, so its request is dropped instead of replayed
+		global _shutdown_requested
+		connection.settimeout(accept_timeout)
+		channel = connection.makefile('rb')
+		line = channel.readline()
+
+		# just a check if we are listening
+		if not line.strip():
+			return
+		request = json.loads(line)
+
+		# decline if code changed, the client runs it and we make room for a fresh worker
+		if self._stamps() != self.stamps:
+			_shutdown_requested = True
+			_send_line(connection, { 'status' : None })
+			return
+
+		try:
+			_send_line(connection, { 'accepted' : True, 'pid' : os.getpid() })
+			if channel.readline().strip() != 'go':
+				return
+		except socket.error:
+			return
+		connection.settimeout(None)
+
+		# run manager like a fresh process would, capturing what it prints for Hype
+		status = 0
+		output = StringIO.StringIO()
+		argv, stdout = sys.argv, sys.stdout
+		sys.argv = [self.manager_file] + request['argv']
+		sys.stdout = output
+		try:
+			self.manager.main()
+		except SystemExit as e:
+			status = e.code if isinstance(e.code, int) else (0 if e.code == None else 1)
+		except Exception:
+			traceback.print_exc()
+			status = 1
+		finally:
+			sys.argv, sys.stdout = argv, stdout
+
+		try:
+			_send_line(connection, { 'status' : status, 'output' : output.getvalue() })
+		except socket.error:
+			pass
+
+
+	'''
+	Code
+	'''
+
+	def _load_manager(self):
+		# load manager script as module (its __main__ block doesn't run)
+		module = imp.new_module('acme_manager')
+		module.__file__ = self.manager_file
+		with open(self.manager_file, 'r') as f:
+			code = compile(f.read(), self.manager_file, 'exec')
+		exec code in module.__dict__
+		return module
+
+
+	def _stamps(self):
+		# modification times of the manager and its libraries
+		files = [self.manager_file] + sorted(glob.glob(os.path.join(self.import_folder, '*.py')))
+		stamps = []
+		for filepath in files:
+			try:
+				stamps.append((filepath, os.path.getmtime(filepath)))
+			except OSError:
+				stamps.append((filepath, None))
+		return stamps
+
+
+
+'''
+Client and control
+'''
+
+def socket_path():
+	# per user socket in the temp folder (short enough for AF_UNIX paths)
+	return os.path.join(tempfile.gettempdir(), 'acme-worker-{}.sock'.format(os.getuid()))
+
+
+def in_worker():
+	# True if this process is the worker
+	return _running
+
+
+def forward_to_worker(argv):
+	# let a running worker handle the call and return its response with
+	# status and output. None if there is no worker or it didn't accept the
+	# request in time (the caller runs it itself). Once accepted the request
+	# is never run twice: if the worker doesn't answer in request_timeout it
+	# is stopped and the response reports the failed export
+	path = socket_path()
+	if _running or not os.path.exists(path):
+		return None
+
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.settimeout(accept_timeout)
+	try:
+		client.connect(path)
+		channel = client.makefile('rb')
+		_send_line(client, { 'argv' : argv })
+		answer = json.loads(channel.readline())
+		if not isinstance(answer, dict) or not answer.get('accepted'):
+			client.close()
+			return None
+		client.sendall('go\n')
+	except (socket.error, ValueError):
+		client.close()
+		return None
+
+	client.settimeout(request_timeout)
+	try:
+		response = json.loads(channel.readline())
+	except (socket.error, ValueError):
+		response = None
+	finally:
+		client.close()
+
+	if not isinstance(response, dict) or response.get('status') == None:
+		# stuck or crashed while running our request, make room for a fresh worker
+		_stop_stuck_worker(answer.get('pid'), path)
+		return { 'status' : 1, 'output' : 'The bundle worker did not finish the request and was stopped, please try again.\n' }
+	return response
+
+
+def start_worker(manager_file, idle_timeout=900):
+	# start a detached worker unless one is listening (or we are the worker)
+	if _running or worker_is_listening():
+		return False
+	with open(os.devnull, 'r+') as devnull:
+		subprocess.Popen(
+			[sys.executable or 'python', os.path.splitext(os.path.abspath(__file__))[0]+'.py', '--serve', os.path.abspath(manager_file), '--idle_timeout', str(idle_timeout)],
+			stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid
+		)
+	return True
+
+
+def stop_worker():
+	# shut down after the current request if we are the worker
+	global _shutdown_requested
+	if _running:
+		_shutdown_requested = True
+
+
+def worker_is_listening():
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		client.connect(socket_path())
+		return True
+	except socket.error:
+		return False
+	finally:
+		client.close()
+
+
+def _stop_stuck_worker(pid, path):
+	# kill a worker that didn't answer an accepted request and remove its socket
+	# so the next call doesn't queue behind it
+	if isinstance(pid, int) and pid != os.getpid():
+		try:
+			os.kill(pid, signal.SIGKILL)
+		except OSError:
+			pass
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+
+
+def _send_line(connection, message):
+	connection.sendall(json.dumps(message)+'\n')
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--serve', required=True, help='manager file')
+	parser.add_argument('--idle_timeout', type=float, default=900)
+	args = parser.parse_args()
+
+	# log errors next to the manager like the manager does
+	sys.stderr = open(os.path.join(os.path.dirname(os.path.abspath(args.serve)), 'errors.log'), 'a')
+
+	# serve from the imported module so the manager sees the worker state
+	import bundleworker
+	bundleworker.BundleWorker(args.serve, args.idle_timeout).serve()
@@ -5,6 +5,13 @@
 #	Helper classes and function for bundles
 #
 #	 v1.0.0 Initial release
+#	 v1.0.1 pluggable compiler backends (remote API and local compiler)
+#	 v1.0.2 content addressed cache with eviction and statistics
+#	 v1.0.3 compile units one by one (incremental)
+#	 v1.0.4 backend and compilation level in cache keys
+#	 v1.0.5 evict once per export
+#	 v1.0.6 one request per script for the Closure API
+#	 v1.0.7 units missing in the cache compiled in one batch and split by markers
 #
 #
 #	MIT License
@@ -16,9 +23,23 @@ import os
 import json
 import hashlib
 import httplib, urllib
+import time
+import shutil
+import tempfile
+import re
+import subprocess
 import traceback
 		
 
+# marks the start of every unit compiled in a batch. Closure keeps @license
+# comments at the start of the output of their input (as /*\n\n text\n*/)
+unit_marker = '/** @license acme-unit-{} */\n'
+unit_marker_pattern = re.compile(r'/\*[\s*]*(?:@license\s+)?acme-unit-(\d+)\s*\*/\n?')
+
+# input number in the file name of an issue (Input_3 from the API, input_3.js locally)
+input_pattern = re.compile(r'input_(\d+)', re.IGNORECASE)
+
+
 # closure warnings and error helper
 def format_closure_feedback(list_of_items, offset=0):
 	js_feedback = ''
@@ -28,68 +49,305 @@ def format_closure_feedback(list_of_items, offset=0):
 		line = e["line"].decode('string_escape')
 		js_feedback += line+"\n "
 		line = e["line"].replace("\t"," "*3)
-		leading = len(line)-len(string.lstrip(line))
+		leading = len(line)-len(line.lstrip())
 		js_feedback += " "*(leading+e["charno"]-1)+"^"+"\n"
 	return js_feedback
 
+
+
+class RemoteClosureBackend:
+	# Closure Compiler service API on closure-compiler.appspot.com. Backends
+	# compile JavaScript (a string or a list of inputs) and return a dict
+	# shaped like the JSON of the API: compiledCode and lists of warnings and
+	# errors, each with type, warning or error, lineno, charno, line and the
+	# number of its input (see format_closure_feedback)
+	name = 'remote'
+
+	def __init__(self, compilation_level='SIMPLE_OPTIMIZATIONS'):
+		self.compilation_level = compilation_level
+
+	def compile(self, js_code):
+		# prepare paramters (every input is a js_code of its own)
+		inputs = js_code if isinstance(js_code, list) else [js_code]
+		params = urllib.urlencode([('js_code', code) for code in inputs] + [
+			('compilation_level', self.compilation_level),
+			('output_format', 'json'),
+			('output_info', 'compiled_code'),
+			('output_info', 'warnings'),
+			('output_info', 'errors'),
+		])
+
+		# send to API
+		headers = { "Content-type": "application/x-www-form-urlencoded" }
+		conn = httplib.HTTPSConnection('closure-compiler.appspot.com')
+		conn.request('POST', '/compile', params, headers)
+		response = conn.getresponse()
+		data = json.loads(response.read().decode('utf-8'))
+		conn.close()
+		for item in data.get('errors', []) + data.get('warnings', []):
+			item['input'] = _input_number(item.get('file'))
+		return data
+
+
+
+class LocalClosureBackend:
+	# locally installed compiler, works offline. A .jar is run with java -jar,
+	# anything else is executed directly (e.g. google-closure-compiler from npm)
+	name = 'local'
+
+	def __init__(self, command, compilation_level='SIMPLE_OPTIMIZATIONS'):
+		self.compilation_level = compilation_level
+		self.command = command
+
+	def compile(self, js_code):
+		argv = ['java', '-jar', self.command] if self.command.endswith('.jar') else [self.command]
+		argv += ['--compilation_level', self.compilation_level, '--error_format', 'JSON']
+
+		# a list of inputs is compiled in one run from files named input_<n>.js
+		input_folder = None
+		if isinstance(js_code, list):
+			input_folder = tempfile.mkdtemp()
+			for number, code in enumerate(js_code):
+				input_path = os.path.join(input_folder, 'input_{}.js'.format(number))
+				save_content(input_path, code)
+				argv += ['--js', input_path]
+			js_code = ''
+
+		try:
+			process = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			compiled_code, feedback = process.communicate(js_code)
+		finally:
+			if input_folder:
+				shutil.rmtree(input_folder, ignore_errors=True)
+
+		# the compiler reports errors and warnings as JSON list on stderr
+		try:
+			issues = json.loads(feedback) if feedback.strip() else []
+		except ValueError:
+			raise RuntimeError("Closure Compiler ({}) failed:\n{}".format(self.command, feedback))
+
+		data = {}
+		for issue in issues:
+			level = issue.get('level')
+			if level not in ('warning', 'error'):
+				continue
+			data.setdefault(level+'s', []).append({
+				'type' : issue.get('key', ''),
+				level : issue.get('description', ''),
+				'lineno' : issue.get('line', 0) or 0,
+				'charno' : issue.get('column', 0) or 0,
+				'line' : (issue.get('context') or '').split("\n")[0],
+				'input' : _input_number(issue.get('source')),
+			})
+
+		if process.returncode == 0 and not 'errors' in data:
+			data['compiledCode'] = compiled_code
+		return data
+
+
+
+def _input_number(name):
+	m = input_pattern.search(name or '')
+	return int(m.group(1)) if m else None
+
+
+def get_closure_backend(local_command=None):
+	# local compiler if one is configured, remote API otherwise
+	if local_command and local_command.strip():
+		return LocalClosureBackend(local_command.strip())
+	return RemoteClosureBackend()
+
+
+
+
+class ClosureCache:
+	# content addressed store for compiler results with one folder per hash
+	# holding code.js, warnings.txt, errors.txt and meta.json (files, size,
+	# created, last access and hits). Entries are written atomically and the
+	# least recently used ones are evicted when the statistics are saved (once
+	# per export) if the store exceeds max_size
+
+	'''
+	Constructor and basics
+	'''
+
+	def __init__(self, folder, max_size=50*1024*1024):
+		self.folder = folder
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		if not os.path.isdir(self.folder):
+			os.makedirs(self.folder)
+
+
+	'''
+	Lookup and store
+	'''
+
+	def get(self, key):
+		# return dict with code (None if there is no code), errors and warnings
+		# or None on a miss. Only meta.json is opened to know what is stored
+		entry_folder = os.path.join(self.folder, key)
+		try:
+			meta = json.loads(read_content(os.path.join(entry_folder, 'meta.json')))
+			entry = {
+				'code' : read_content(os.path.join(entry_folder, 'code.js')) if 'code' in meta['files'] else None,
+				'errors' : read_content(os.path.join(entry_folder, 'errors.txt')) if 'errors' in meta['files'] else '',
+				'warnings' : read_content(os.path.join(entry_folder, 'warnings.txt')) if 'warnings' in meta['files'] else '',
+			}
+		except (IOError, OSError, ValueError, KeyError):
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		meta['hits'] = meta.get('hits', 0) + 1
+		meta['last_access'] = time.time()
+		try:
+			_save_atomic(os.path.join(entry_folder, 'meta.json'), json.dumps(meta))
+		except (IOError, OSError):
+			pass
+		return entry
+
+
+	def set(self, key, code=None, errors='', warnings=''):
+		# write entry into a temporary folder and move it in place in one rename
+		temp_folder = tempfile.mkdtemp(dir=self.folder, prefix='.'+key)
+		files = {}
+		for name, filename, content in [('code', 'code.js', code), ('errors', 'errors.txt', errors), ('warnings', 'warnings.txt', warnings)]:
+			if content:
+				save_content(os.path.join(temp_folder, filename), content)
+				files[name] = len(content)
+
+		now = time.time()
+		save_content(os.path.join(temp_folder, 'meta.json'), json.dumps({
+			'files' : files,
+			'size' : sum(files.values()),
+			'created' : now,
+			'last_access' : now,
+			'hits' : 0,
+		}))
+
+		entry_folder = os.path.join(self.folder, key)
+		try:
+			if os.path.isdir(entry_folder):
+				shutil.rmtree(entry_folder, ignore_errors=True)
+			os.rename(temp_folder, entry_folder)
+		except OSError:
+			# someone else stored the same entry in the meantime
+			shutil.rmtree(temp_folder, ignore_errors=True)
+
+
+	def evict(self):
+		# remove least recently used entries until we are below max_size
+		entries = []
+		total = 0
+		for name in os.listdir(self.folder):
+			path = os.path.join(self.folder, name)
+			if name.startswith('.'):
+				# abandoned temporary folders
+				if os.path.isdir(path) and time.time() - os.path.getmtime(path) > 3600:
+					shutil.rmtree(path, ignore_errors=True)
+				continue
+			if not os.path.isdir(path):
+				# loose files from the old cache layout (<md5>.js, .warn, .error)
+				if os.path.splitext(name)[1] in ('.js', '.warn', '.error'):
+					try:
+						os.remove(path)
+					except OSError:
+						pass
+				continue
+			try:
+				meta = json.loads(read_content(os.path.join(path, 'meta.json')))
+			except (IOError, OSError, ValueError):
+				continue
+			entries.append((meta.get('last_access', 0), meta.get('size', 0), path))
+			total += meta.get('size', 0)
+
+		for last_access, size, path in sorted(entries):
+			if total <= self.max_size:
+				break
+			shutil.rmtree(path, ignore_errors=True)
+			total -= size
+
+
+	'''
+	Statistics
+	'''
+
+	def stats(self):
+		# hit and miss counters of this run and the totals including previous runs
+		try:
+			totals = json.loads(read_content(os.path.join(self.folder, 'stats.json')))
+		except (IOError, OSError, ValueError):
+			totals = {}
+		return {
+			'hits' : self.hits,
+			'misses' : self.misses,
+			'total_hits' : totals.get('hits', 0) + self.hits,
+			'total_misses' : totals.get('misses', 0) + self.misses,
+		}
+
+
+	def save_stats(self):
+		# add counters of this run to the totals in stats.json and evict
+		# (scanning the store on every set would make cold compiles quadratic)
+		self.evict()
+		stats = self.stats()
+		try:
+			_save_atomic(os.path.join(self.folder, 'stats.json'), json.dumps({
+				'hits' : stats['total_hits'],
+				'misses' : stats['total_misses'],
+			}))
+			self.hits = self.misses = 0
+		except (IOError, OSError):
+			pass
+		return stats
+
+
+
 # closure API
-def compile_with_closure(js_code, cache_folder):
+def compile_with_closure(js_code, cache, backend=None):
 	# prep
 	js_warnings = ''
 	js_errors = ''
 
+	# cache can be given as ClosureCache or folder
+	if isinstance(cache, basestring):
+		cache = ClosureCache(cache)
+
+	# default to the Closure API
+	if backend == None:
+		backend = RemoteClosureBackend()
+
 	# check if we compile the code already and return it
-	# TBD maybe a folder with 3 files instead of 3 files
-	code_cache_file_md5 = os.path.join(cache_folder, hashlib.md5(js_code).hexdigest())
-	
-	# read warnings
-	if os.path.isfile(code_cache_file_md5+'.warn'):
-		js_warnings = read_content(code_cache_file_md5+'.warn')
-		
-	# if we got an error code wasn't generated so return bad code and error
-	if os.path.isfile(code_cache_file_md5+'.error'):
-		js_errors = read_content(code_cache_file_md5+'.error')
-		return js_code, js_errors, js_warnings
-	
-	#if we got code return cached code and optional warning
-	if os.path.isfile(code_cache_file_md5+'.js'):
-		js_code = read_content(code_cache_file_md5+'.js')
-		return js_code, js_errors, js_warnings
+	key = closure_cache_key(js_code, backend)
+	entry = cache.get(key)
+	if entry != None:
+		js_warnings = entry['warnings']
+
+		# if we got an error code wasn't generated so return bad code and error
+		if entry['errors']:
+			return js_code, entry['errors'], js_warnings
+
+		#if we got code return cached code and optional warning
+		if entry['code'] != None:
+			return entry['code'], js_errors, js_warnings
 
-	# TODO add statistics
 	# TBD check if we can use code_url to bundle runtime from CDN (full, min)
 
-	# prepare paramters
-	params = urllib.urlencode([
-		('js_code', js_code),
-		('compilation_level', 'SIMPLE_OPTIMIZATIONS'),
-		('output_format', 'json'),
-		('output_info', 'compiled_code'),
-		('output_info', 'warnings'),
-		('output_info', 'errors'),
-	])
-
-	# send to API
-	headers = { "Content-type": "application/x-www-form-urlencoded" }
-	
-	# let us try to request a compiler API session
+	# let us try to compile with the backend
 	try:
-		conn = httplib.HTTPSConnection('closure-compiler.appspot.com')
-		conn.request('POST', '/compile', params, headers)
-		response = conn.getresponse()
-		data = json.loads(response.read().decode('utf-8'))
-		conn.close()
+		data = backend.compile(js_code)
 		
 		# TODO make warnings a list (countable) and return closure maybe a dict
-		if "warnings" in data and data["warnings"]!="":
+		if "warnings" in data and data["warnings"]:
 			js_warnings = format_closure_feedback(data["warnings"], len(data.get("errors",[]))*4+4)
-			save_content(code_cache_file_md5+'.warn', js_warnings)
 
 		# ckeck if we got the code
 		if "compiledCode" in data and data["compiledCode"]!="":
 
 			# cache compiled code using hashlib 
-			save_content(code_cache_file_md5+'.js', data["compiledCode"])
+			cache.set(key, code=data["compiledCode"], warnings=js_warnings)
 
 			# return
 			return data["compiledCode"], js_errors, js_warnings
@@ -97,7 +355,7 @@ def compile_with_closure(js_code, cache_folder):
 			# compiler error 
 			if "errors" in data:
 				js_errors += format_closure_feedback(data["errors"], len(data["errors"])*4+4)
-				save_content(code_cache_file_md5+'.error', js_errors)
+				cache.set(key, errors=js_errors, warnings=js_warnings)
 
 				# append it to the return and code
 				temp = "/* Closure Compiler\n\n"
@@ -115,6 +373,117 @@ def compile_with_closure(js_code, cache_folder):
 		return js_code, js_errors, js_warnings
 
 
+def closure_cache_key(js_code, backend):
+	# results differ by compiler and compilation level, not only by code
+	return hashlib.md5(backend.name+"\n"+backend.compilation_level+"\n"+js_code).hexdigest()
+
+
+def compile_units_with_closure(units, cache, backend=None):
+	# compile and cache every unit of JavaScript on its own and join the results
+	# so changing one unit only recompiles that unit. Units missing in the cache
+	# are compiled together (one request or compiler run, every unit an input
+	# of its own) and the output is split back into units by their markers
+	if backend == None:
+		backend = RemoteClosureBackend()
+
+	keys = [closure_cache_key(unit, backend) for unit in units]
+	results = [None] * len(units)
+	pending = []
+	for index, unit in enumerate(units):
+		entry = cache.get(keys[index])
+		if entry != None and entry['errors']:
+			results[index] = (unit, entry['errors'], entry['warnings'])
+		elif entry != None and entry['code'] != None:
+			results[index] = (entry['code'], '', entry['warnings'])
+		else:
+			pending.append(index)
+
+	# a second batch compiles the units that were held back by errors in others
+	for attempt in range(2):
+		if not pending:
+			break
+		try:
+			batch = _compile_batch([units[index] for index in pending], backend)
+		except Exception:
+			# compiler missing or unreachable, report once and keep the code
+			js_errors = traceback.format_exc()
+			for index in pending:
+				results[index] = (units[index], '', '')
+			results[pending[0]] = ('/* ' + js_errors + '\n\n*/\n' + units[pending[0]], js_errors, '')
+			pending = []
+			break
+
+		held_back = []
+		for index, (code, js_errors, js_warnings) in zip(pending, batch):
+			if js_errors:
+				cache.set(keys[index], errors=js_errors, warnings=js_warnings)
+				results[index] = ("/* Closure Compiler\n\n" + js_errors + "*/\n\n" + units[index], js_errors, js_warnings)
+			elif code != None:
+				cache.set(keys[index], code=code, warnings=js_warnings)
+				results[index] = (code, '', js_warnings)
+			else:
+				held_back.append(index)
+		pending = held_back
+
+	# output that couldn't be split is compiled unit by unit
+	for index in pending:
+		results[index] = compile_with_closure(units[index], cache, backend)
+
+	js_code = "\n".join([result[0] for result in results])
+	js_errors = "".join([result[1] for result in results])
+	js_warnings = "".join([result[2] for result in results])
+	return js_code, js_errors, js_warnings
+
+
+def _compile_batch(units, backend):
+	# compile units as inputs of one run and return (code, errors, warnings)
+	# per unit. Code is None for units without errors of their own if the run
+	# had errors or its output couldn't be split
+	data = backend.compile([unit_marker.format(number) + unit for number, unit in enumerate(units)])
+
+	feedback = [{ 'errors' : [], 'warnings' : [] } for unit in units]
+	unassigned_errors = False
+	for level in ['errors', 'warnings']:
+		for item in data.get(level, []):
+			number = item.get('input')
+			if number == None or not 0 <= number < len(units):
+				unassigned_errors = unassigned_errors or level == 'errors'
+				continue
+			# line numbers without the marker line
+			feedback[number][level].append(dict(item, lineno=max(item.get('lineno', 1) - 1, 0)))
+
+	codes = [None] * len(units)
+	if not data.get('errors') and data.get('compiledCode'):
+		codes = _split_units(data['compiledCode'], len(units))
+
+	results = []
+	for number, unit in enumerate(units):
+		errors, warnings = feedback[number]['errors'], feedback[number]['warnings']
+		offset = len(errors)*4+4
+		results.append((
+			codes[number],
+			format_closure_feedback(errors, offset) if errors else '',
+			format_closure_feedback(warnings, offset) if warnings else '',
+		))
+	if unassigned_errors and not any(result[1] for result in results):
+		raise RuntimeError('Closure Compiler reported errors outside of the compiled units:\n' + format_closure_feedback(data['errors']))
+	return results
+
+
+def _split_units(compiled_code, count):
+	# code per unit from the output of a batch, all None if the markers are not
+	# there in order (the compiler moved or dropped them)
+	markers = list(unit_marker_pattern.finditer(compiled_code))
+	if [int(m.group(1)) for m in markers] != range(count):
+		return [None] * count
+	ends = [m.start() for m in markers[1:]] + [len(compiled_code)]
+	codes = [compiled_code[m.end():end].strip("\n") for m, end in zip(markers, ends)]
+	# anything the compiler put before the first marker belongs to the first unit
+	if count and markers[0].start():
+		codes[0] = compiled_code[:markers[0].start()] + codes[0]
+	return codes
+
+
 def read_content(filepath):
 	with open(filepath, "r") as f:
 		return f.read()
@@ -122,4 +491,11 @@ def read_content(filepath):
 def save_content(filepath, content):
 	with open(filepath, "w") as f:
 		f.write(content)
-		#f.write(content.encode('utf-8'))
\ No newline at end of file
+		#f.write(content.encode('utf-8'))
+
+def _save_atomic(filepath, content):
+	# write next to the target and rename it in place
+	handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix='.tmp')
+	with os.fdopen(handle, 'w') as f:
+		f.write(content)
+	os.rename(temp_path, filepath)
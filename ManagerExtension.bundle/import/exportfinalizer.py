@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# 	exportfinalizer.py
+#	Move the staging folder to the export destination
+#
+#	 v1.0.0 Initial release, rename into place with deferred delete
+#	 v1.0.1 deferred deletes in detached processes that outlive the manager
+#	 v1.0.2 claim folders before deleting them so sweeps don't delete twice
+#
+#
+#	MIT License
+#	Copyright (c) 2021 Max Ziebell
+#
+
+import os
+import time
+import shutil
+import fnmatch
+import subprocess
+
+
+# prefix of folders waiting to be deleted
+trash_prefix = '.acme-trash-'
+
+# prefix of folders a delete was started for (followed by the claim time)
+deleting_prefix = trash_prefix+'deleting-'
+
+# seconds after which a claimed folder is deleted again (its rm was stopped)
+deleting_grace_period = 3600
+
+# deletes running in the background as detached rm processes (they keep
+# running after the manager exits, leftovers are found by the next sweep)
+_pending_deletes = []
+
+
+
+'''
+Finalize
+'''
+
+def finalize_export(staging_path, destination_path, trash_folder=None):
+	# replace destination_path with staging_path and return how it was done:
+	# 'rename' if both are on the same volume (the old destination is moved
+	# aside and deleted in the background) or 'copy' if not (only changed
+	# files are copied and the staging folder is deleted in the background)
+	staging_path = os.path.abspath(staging_path)
+	destination_path = os.path.abspath(destination_path)
+	parent = os.path.dirname(destination_path)
+	if not os.path.isdir(parent):
+		os.makedirs(parent)
+
+	# finish deletes of earlier runs
+	sweep_trash(parent, trash_folder)
+
+	if _same_device(staging_path, parent):
+		if os.path.lexists(destination_path):
+			trash_path = _trash_path(destination_path, trash_folder)
+			os.rename(destination_path, trash_path)
+			delete_in_background(trash_path)
+		os.rename(staging_path, destination_path)
+		return 'rename'
+
+	sync_tree(staging_path, destination_path)
+	delete_in_background(staging_path)
+	return 'copy'
+
+
+def sync_tree(source, target):
+	# make target a copy of source, skipping files whose size and mtime are
+	# unchanged and removing what source doesn't have. Returns copied and skipped count
+	copied = skipped = 0
+	for path, dirs, files in os.walk(source):
+		target_path = os.path.join(target, os.path.relpath(path, source))
+		if not os.path.isdir(target_path):
+			if os.path.lexists(target_path):
+				os.remove(target_path)
+			os.makedirs(target_path)
+		for filename in files:
+			source_file = os.path.join(path, filename)
+			target_file = os.path.join(target_path, filename)
+			if _unchanged(source_file, target_file):
+				skipped += 1
+				continue
+			if os.path.isdir(target_file) and not os.path.islink(target_file):
+				shutil.rmtree(target_file)
+			shutil.copy2(source_file, target_file)
+			copied += 1
+
+	# remove what is gone from source
+	for path, dirs, files in os.walk(target, topdown=False):
+		source_path = os.path.join(source, os.path.relpath(path, target))
+		for name in files + dirs:
+			if not os.path.lexists(os.path.join(source_path, name)):
+				doomed = os.path.join(path, name)
+				if os.path.isdir(doomed) and not os.path.islink(doomed):
+					shutil.rmtree(doomed, ignore_errors=True)
+				else:
+					os.remove(doomed)
+	return copied, skipped
+
+
+
+'''
+Deferred deletes
+'''
+
+def delete_in_background(path):
+	# claim path, reap finished deletes (the worker is long-lived) and start a
+	# new one. Returns None if path is gone or another process claimed it
+	claimed_path = _claim(path)
+	if not claimed_path:
+		return None
+	_reap_deletes()
+	with open(os.devnull, 'r+') as devnull:
+		process = subprocess.Popen(['rm', '-rf', claimed_path], stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+	_pending_deletes.append(process)
+	return process
+
+
+def wait_for_deletes(timeout=None):
+	# wait up to timeout seconds for background deletes (returns True if all finished)
+	deadline = time.time() + timeout if timeout != None else None
+	while _reap_deletes():
+		if deadline != None and time.time() >= deadline:
+			return False
+		time.sleep(0.05)
+	return True
+
+
+def _reap_deletes():
+	# forget finished deletes and return how many are still running
+	for process in list(_pending_deletes):
+		if process.poll() != None:
+			_pending_deletes.remove(process)
+	return len(_pending_deletes)
+
+
+def sweep_trash(parent, trash_folder=None):
+	# delete leftovers of earlier runs next to the destination and in the trash folder
+	for folder in [parent, trash_folder]:
+		if not folder or not os.path.isdir(folder):
+			continue
+		for name in fnmatch.filter(os.listdir(folder), trash_prefix+'*'):
+			# a delete is running for claimed folders unless it was stopped long ago
+			if name.startswith(deleting_prefix) and not _claim_expired(name):
+				continue
+			delete_in_background(os.path.join(folder, name))
+
+
+def _claim(path):
+	# rename path to a deleting name with the current time so only one delete
+	# runs for it (renames are atomic, a second claim finds path gone)
+	name = os.path.basename(path)
+	if name.startswith(deleting_prefix):
+		name = name[len(deleting_prefix):].partition('-')[2]
+	claimed_path = os.path.join(os.path.dirname(path), '{}{}-{}'.format(deleting_prefix, int(time.time()), name))
+	try:
+		os.rename(path, claimed_path)
+	except OSError:
+		return None
+	return claimed_path
+
+
+def _claim_expired(name):
+	# True if the claim time in a deleting name is older than the grace period
+	stamp = name[len(deleting_prefix):].partition('-')[0]
+	try:
+		return time.time() - int(stamp) > deleting_grace_period
+	except ValueError:
+		return True
+
+
+def _trash_path(path, trash_folder):
+	# unique name in the trash folder if it is on the volume of path
+	# (keeps destination folders tidy) else next to path
+	name = '{}{}-{}-{}'.format(trash_prefix, os.getpid(), int(time.time()*1000), os.path.basename(path))
+	if trash_folder:
+		if not os.path.isdir(trash_folder):
+			try:
+				os.makedirs(trash_folder)
+			except OSError:
+				pass
+		if os.path.isdir(trash_folder) and _same_device(trash_folder, os.path.dirname(path)):
+			return os.path.join(trash_folder, name)
+	return os.path.join(os.path.dirname(path), name)
+
+
+def _same_device(first, second):
+	try:
+		return os.stat(first).st_dev == os.stat(second).st_dev
+	except OSError:
+		return False
+
+
+def _unchanged(source_file, target_file):
+	# same size and (whole second) modification time as copy2 leaves them
+	try:
+		source_stat = os.stat(source_file)
+		target_stat = os.lstat(target_file)
+	except OSError:
+		return False
+	return source_stat.st_size == target_stat.st_size and int(source_stat.st_mtime) == int(target_stat.st_mtime)
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# 	exporttrace.py
+#	Timing of export phases and bundle runs with an optional cProfile hook
+#
+#	 v1.0.0 Initial release
+#
+#
+#	MIT License
+#	Copyright (c) 2021 Max Ziebell
+#
+
+import os
+import json
+import time
+import pstats
+import cProfile
+import StringIO
+import tempfile
+import threading
+import contextlib
+
+
+
+class ExportTrace:
+
+	'''
+	Constructor and basics
+	'''
+
+	def __init__(self, on_span=None):
+		# on_span(name, category, seconds) is called for every finished span
+		# (the manager writes them as timing records to its log)
+		self.started = time.time()
+		self.spans = []
+		self.on_span = on_span
+		self.profiler = None
+		self.profile = None
+		self._lock = threading.Lock()
+
+
+	@contextlib.contextmanager
+	def span(self, name, category='phase'):
+		# time a with block, spans can be opened from several threads
+		start = time.time()
+		try:
+			yield
+		finally:
+			duration = time.time() - start
+			with self._lock:
+				self.spans.append({
+					'name' : name,
+					'category' : category,
+					'start' : start - self.started,
+					'duration' : duration,
+					'thread' : threading.current_thread().name,
+				})
+			if self.on_span:
+				self.on_span(name, category, duration)
+
+
+	'''
+	Profiler
+	'''
+
+	def start_profiler(self):
+		# profile the calling thread until stop_profiler
+		self.profiler = cProfile.Profile()
+		self.profiler.enable()
+
+
+	def stop_profiler(self, stats_path=None, limit=25):
+		# keep the top functions by cumulative time for the report
+		# and optionally the full stats for pstats or snakeviz
+		if not self.profiler:
+			return None
+		self.profiler.disable()
+		if stats_path:
+			try:
+				self.profiler.dump_stats(stats_path)
+			except (IOError, OSError):
+				pass
+		output = StringIO.StringIO()
+		pstats.Stats(self.profiler, stream=output).sort_stats('cumulative').print_stats(limit)
+		self.profile = output.getvalue()
+		self.profiler = None
+		return self.profile
+
+
+	'''
+	Reports
+	'''
+
+	def phases(self):
+		return sorted([span for span in self.spans if span['category'] == 'phase'], key=lambda span: span['start'])
+
+
+	def slowest(self, category, limit=None):
+		spans = sorted([span for span in self.spans if span['category'] == category], key=lambda span: -span['duration'])
+		return spans[:limit] if limit else spans
+
+
+	def report(self, **info):
+		return {
+			'info' : info,
+			'started' : self.started,
+			'total' : time.time() - self.started,
+			'phases' : self.phases(),
+			'bundles' : self.slowest('bundle'),
+			'spans' : sorted(self.spans, key=lambda span: span['start']),
+			'profile' : self.profile,
+		}
+
+
+	def save(self, filepath, **info):
+		# write the report atomically, returns False if it couldn't be written
+		try:
+			folder = os.path.dirname(filepath)
+			if not os.path.isdir(folder):
+				os.makedirs(folder)
+			handle, temp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+			with os.fdopen(handle, 'w') as f:
+				json.dump(self.report(**info), f, indent=1)
+			os.rename(temp_path, filepath)
+			return True
+		except (IOError, OSError):
+			return False
+
+
+	def overlay_data(self, limit=5):
+		# what the preview overlay shows: phases so far and the slowest bundles (ms)
+		return json.dumps({
+			'total' : int((time.time() - self.started)*1000),
+			'phases' : [[span['name'], int(span['duration']*1000)] for span in self.phases()],
+			'bundles' : [[span['name'], int(span['duration']*1000)] for span in self.slowest('bundle', limit)],
+		})
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# 	htmlinject.py
+#	Insert bundle results into the index HTML in a single pass
+#
+#	 v1.0.0 Initial release
+#
+#
+#	MIT License
+#	Copyright (c) 2021 Max Ziebell
+#
+
+import os
+import re
+import mmap
+import tempfile
+
+
+# insert points with the tag they are anchored to, inserting after the match
+# (start of head and body) or before it (end of head and body). The order
+# decides who goes first if two points share an offset
+insert_points = [
+	('insert_at_head_start', '<head.*?>', True),
+	('insert_at_head_end', '</head', False),
+	('insert_at_body_start', '<body.*?>', True),
+	('insert_at_body_end', '</body', False),
+]
+
+# all anchors in one alternation, group n+1 belongs to insert point n
+anchor_pattern = re.compile('|'.join('('+pattern+')' for key, pattern, after in insert_points), re.IGNORECASE)
+
+
+
+'''
+Offsets
+'''
+
+def find_insert_offsets(html, keys=None):
+	# scan once for the first match of every anchor and return the offsets
+	# of the requested insert points (all by default) by key
+	wanted = set(keys if keys != None else [key for key, pattern, after in insert_points])
+	offsets = {}
+	for m in anchor_pattern.finditer(html):
+		index = m.lastindex - 1
+		key, pattern, after = insert_points[index]
+		if key in wanted and key not in offsets:
+			offsets[key] = m.end() if after else m.start()
+			if len(offsets) == len(wanted):
+				break
+
+	missing = wanted.difference(offsets)
+	if missing:
+		raise ValueError('no anchor found for '+', '.join(sorted(missing)))
+	return offsets
+
+
+def _plan(html, inserts):
+	# list of (offset, text) in output order for the inserts that have content
+	texts = {}
+	for key, pattern, after in insert_points:
+		text = _as_text(inserts.get(key))
+		if text:
+			texts[key] = text
+	if not texts:
+		return []
+
+	offsets = find_insert_offsets(html, texts.keys())
+	plan = []
+	for rank, (key, pattern, after) in enumerate(insert_points):
+		if key in texts:
+			plan.append((offsets[key], rank, texts[key]))
+	plan.sort()
+	return [(offset, text) for offset, rank, text in plan]
+
+
+def _as_text(value):
+	# inserts are lists joined by line breaks or plain strings
+	if value == None:
+		return ''
+	if isinstance(value, (list, tuple)):
+		value = "\n".join(value)
+	if isinstance(value, unicode):
+		value = value.encode('utf-8')
+	return value
+
+
+
+'''
+Insert
+'''
+
+def inject_html(html, inserts):
+	# return html with the inserts by insert point key, building the result once
+	pieces = []
+	position = 0
+	for offset, text in _plan(html, inserts):
+		pieces.append(html[position:offset])
+		pieces.append(text)
+		position = offset
+	if not pieces:
+		return html
+	pieces.append(html[position:])
+	return ''.join(pieces)
+
+
+def inject_html_file(source_path, inserts, target_path=None):
+	# stream source_path with the inserts into target_path (in place by default)
+	# without loading the file as a string. Returns False if nothing was inserted
+	target_path = target_path or source_path
+	with open(source_path, 'rb') as source:
+		stat = os.fstat(source.fileno())
+		size = stat.st_size
+		html = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) if size else ''
+		try:
+			plan = _plan(html, inserts)
+			if not plan:
+				if target_path != source_path:
+					with open(target_path, 'wb') as target:
+						target.write(html[:])
+				return False
+
+			# write to a temporary file next to the target and move it in place
+			handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target_path)), suffix='.tmp')
+			try:
+				with os.fdopen(handle, 'wb') as target:
+					position = 0
+					for offset, text in plan:
+						target.write(html[position:offset])
+						target.write(text)
+						position = offset
+					target.write(html[position:])
+				os.chmod(temp_path, stat.st_mode & 0777)
+				os.rename(temp_path, target_path)
+			except Exception:
+				if os.path.exists(temp_path):
+					os.remove(temp_path)
+				raise
+		finally:
+			if size:
+				html.close()
+	return True
@@ -5,6 +5,15 @@
 #	Helper classes and function for bundles
 #
 #	 v1.0.0 Initial release
+#	 v1.0.1 precompiled templates with ${ifdef ...}
+#	 v1.0.2 framed result channel for the manager
+#	 v1.0.3 asset provisioning from a content hashed store
+#	 v1.0.4 update checks from a timestamp store, fetched in the background
+#	 v1.0.5 buffered, levelled and rotating logs with timing records
+#	 v1.0.6 capabilities declared to the manager
+#	 v1.0.7 assets are declared with the result and placed by the manager
+#	 v1.0.8 update checks fetch in a detached process and never wait
+#	 v1.0.9 different assets for the same target are reported, not replaced
 #
 #
 #	MIT License
@@ -17,9 +26,35 @@ import argparse
 import json
 import re
 import io
+import stat as stat_module
+import shutil
+import hashlib
+import tempfile
+import subprocess
+import time
+import threading
+import atexit
+import contextlib
 import distutils.util
 
 
+# the manager passes a pipe for results in this environment variable. Results are
+# written as frames "<kind> <name> <length>\n<payload>" after a version line so
+# inserts travel as raw text and logging on stdout can't corrupt them
+RESULT_FD_VARIABLE = 'HYPEBUNDLE_RESULT_FD'
+RESULT_CHANNEL_VERSION = 1
+RESULT_CHANNEL_MAGIC = 'HYPEBUNDLE-RESULT'
+
+
+
+class BundleExit(SystemExit):
+	# raised by exit_with_result when a bundle runs in-process
+	# so the manager can take back the result without a subprocess
+	def __init__(self, result):
+		SystemExit.__init__(self, 0)
+		self.result = result
+
+
 
 class HypeBaseBundle:
 	# store user variables
@@ -28,6 +63,7 @@ class HypeBaseBundle:
 	# store registerd values
 	_extra_actions = {}
 	_save_options = {}
+	_capabilities = {}
 
 	# unicode symbol for indentations
 	_L = u'\u2570' #╰
@@ -41,6 +77,19 @@ class HypeBaseBundle:
 		# store settings for later
 		self.settings = settings
 
+		# store user variables per instance (bundles can share a process)
+		self._variable_lookup = {}
+		self.document_arguments_variables = {}
+
+		# merged variable lookups (rebuilt after variables change)
+		self._variables_cache = {}
+
+		# buffered log (created on first use)
+		self._logger = None
+
+		# assets declared with provide_asset (returned with the result)
+		self._assets = []
+
 		# store file and folder for later use
 		# check if a file was given or default to main file
 		self.file = self.settings.get('file', sys.modules['__main__'].__file__)
@@ -84,63 +133,101 @@ class HypeBaseBundle:
 			self.args.is_preview = bool(distutils.util.strtobool(self.args.is_preview))
 
 
-	def log(self, content, truncate=False):
-		# try to log in file base on bundle name
+	def log(self, content, truncate=False, level='info'):
+		# buffer a line for Logs/<bundle>.log, written once at exit_with_result
+		# (truncate starts the log over, lines below the log level are dropped)
 		try:
-			with open(os.path.join(self.logs_folder, self.folder_name + '.log'), "a") as f:
-				if truncate: f.truncate(0) 
-				f.writelines([content.encode('utf-8'), "\n"])
+			self._get_logger().write(content, level, truncate)
 			return True
 		except Exception:
 			return False
 
 
+	def log_timing(self, step, seconds):
+		# timing record for a step (see BundleLogger.timing_pattern)
+		return self.log('{}{}\t{:.6f}'.format(BundleLogger.timing_marker, step, seconds), level='timing')
+
+
+	@contextlib.contextmanager
+	def timed(self, step):
+		# log the duration of a with block as a timing record
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.log_timing(step, time.time() - start)
+
+
+	def flush_log(self):
+		# logging never fails a bundle
+		try:
+			if self._logger:
+				self._logger.flush()
+			return True
+		except Exception:
+			return False
+
+
+	def _get_logger(self):
+		if self._logger == None:
+			self._logger = BundleLogger(
+				os.path.join(self.logs_folder, self.folder_name + '.log'),
+				level = os.environ.get('HYPEBUNDLE_LOG_LEVEL', self.settings.get('log_level', 'info')),
+				max_size = self.settings.get('log_max_size', 1024*1024),
+				backups = self.settings.get('log_backups', 3),
+			)
+		return self._logger
+
+
 	'''
 	Templating (for bundle)
 	'''
 
 	def template_variables(self, string, additional_lookup={}, remove_private_document_arguments=True):
-		# local dict
-		lookup = {}
-		
-		# update with document arguments and user defiend variables
-		lookup.update(self.get_all_variables())
-
-		# remove document arguments starting with an underscore 
-		if remove_private_document_arguments:
-			lookup = { key:value for (key,value) in lookup.items() if key[0:1] != '_'}
+		# document arguments and user defined variables
+		# (optionally without the ones starting with an underscore)
+		lookup = self._get_variables('public' if remove_private_document_arguments else 'all')
 
-		# add ad hoc variables added to the update
-		lookup.update(additional_lookup)
-		
-		# replace variables in string
-		return template_variables(string, lookup)
+		# ad hoc variables take precedence, render without merging dicts
+		try:
+			return compile_template(string).render(additional_lookup, lookup)
+		except Exception:
+			return string
 
 		
 	def get_all_variables(self):
-		variables = self.document_arguments_variables.copy()
-		variables.update(self._variable_lookup)
-		return variables
+		return self._get_variables('all').copy()
 
 
 	def get_variable(self, key, default=''):
-		value = self.get_all_variables().get(key, default)
+		value = self._get_variables('all').get(key, default)
 		return '' if value == None else value
 
 		
 	def set_variable(self, key, value=None):
 		self._variable_lookup[key] = value
+		self._variables_cache = {}
+
+
+	def _get_variables(self, kind):
+		# merged lookups are built once and reused until variables change
+		if kind not in self._variables_cache:
+			variables = self.document_arguments_variables.copy()
+			variables.update(self._variable_lookup)
+			if kind == 'public':
+				variables = { key:value for (key,value) in variables.items() if key[0:1] != '_'}
+			self._variables_cache[kind] = variables
+		return self._variables_cache[kind]
 
 
 	def _prepare_document_variables(self):
 		# try extracting all variable into class for a static lookup
 		# called after registering document arguments when values are expected
 		try:
-			def check(l): return 'variable' in l
-			document_arguments_with_variables = list(filter(check, self.document_arguments_lookup))
-			self.document_arguments_variables = {arg['variable'] : self.get_document_argument_value_by_variable(arg['variable']) for arg in document_arguments_with_variables}
+			self.document_arguments_variables = {variable : self._get_document_argument_value_at(index) for (variable, index) in self._document_arguments_by_variable.items()}
 		except KeyError:
 			self.document_arguments_variables = {}
+		self._variables_cache = {}
 
 
 	'''
@@ -151,6 +238,9 @@ class HypeBaseBundle:
 		# try to load export info based on args.export_info_json_path
 		# only works in args.modify_staging_path
 		# return success as boolean
+		if 'export_info' in self.settings:
+			self.export_info = self.settings['export_info']
+			return True
 		try:
 			export_info_file = open(self.args.export_info_json_path)
 			self.export_info = json.loads(export_info_file.read())
@@ -174,6 +264,25 @@ class HypeBaseBundle:
 	'''
 
 	def exit_with_result(self, result):
+		# write what we logged in one go
+		self.flush_log()
+
+		# declared assets travel with the result so the manager can place them
+		# for cached results too
+		if self._assets and isinstance(result, dict):
+			result = dict(result, assets=list(result.get('assets', [])) + self._assets)
+
+		# hand result back to the manager if we are running in-process
+		if self.settings.get('in_process'):
+			raise BundleExit(result)
+
+		# hand result to the manager over the result channel if it gave us one
+		fd = os.environ.get(RESULT_FD_VARIABLE)
+		if fd:
+			sys.stdout.flush()
+			write_result_frames(int(fd), result)
+			sys.exit(0)
+
 		# exit bundle and return options back to Hype
 		print "===================="
 		print json.dumps({"result" : result})
@@ -190,6 +299,17 @@ class HypeBaseBundle:
 		# Hence, unfortunately changing indentation or the label results in loosing the stored values
 		self.document_arguments_lookup = document_arguments_lookup
 		self.document_arguments_list = [self._indent_document_argument(arg) for arg in document_arguments_lookup]
+
+		# index registered arguments once so lookups by label and variable are dict hits
+		# (the first registered argument wins if a label or variable is used twice)
+		self._document_arguments_by_label = {}
+		self._document_arguments_by_variable = {}
+		for index, arg in enumerate(document_arguments_lookup):
+			if 'label' in arg:
+				self._document_arguments_by_label.setdefault(arg['label'], index)
+			if 'variable' in arg:
+				self._document_arguments_by_variable.setdefault(arg['variable'], index)
+
 		if self.args.modify_staging_path:
 			self._prepare_document_variables()
 
@@ -213,13 +333,11 @@ class HypeBaseBundle:
 
 	def get_document_argument_value_by_label(self, label, default=''):
 		# try returning a document argument value using the registerd label name
-		# by filtering the registered arguments and genereating the raw lookup key
+		# by looking up its index and the precomputed raw lookup key
 		try:
-			def check(l): return label == l.get('label')
-			arg = list(filter(check, self.document_arguments_lookup))
-			if len(arg) > 0:
-				key = self._indent_document_argument(arg[0])
-				return self.document_arguments[key]
+			index = self._document_arguments_by_label.get(label)
+			if index != None:
+				return self.document_arguments[self.document_arguments_list[index]]
 		except KeyError:
 			pass
 		return default
@@ -227,15 +345,11 @@ class HypeBaseBundle:
 
 	def get_document_argument_value_by_variable(self, variable, default=''):
 		# try returning a document argument value using the registerd variable name
-		# by filtering the registered arguments and genereating the raw lookup key
+		# by looking up its index and the precomputed raw lookup key
 		try:
-			def check(l): return variable == l.get('variable')
-			arg = list(filter(check, self.document_arguments_lookup))
-			if len(arg) > 0:
-				key = self._indent_document_argument(arg[0])
-				default = arg[0].get('default')
-				value = self.document_arguments.get(key, default)
-				return value if value and not value.isspace() else default
+			index = self._document_arguments_by_variable.get(variable)
+			if index != None:
+				return self._get_document_argument_value_at(index)
 		except KeyError:
 			pass
 		return default
@@ -245,14 +359,21 @@ class HypeBaseBundle:
 		# try returning a document argument value using the index
 		# by returning the value from the given indexed argument in the registered dict
 		try:
-			if index < len(self.document_arguments_lookup):
-				key = self._indent_document_argument(self.document_arguments_lookup[index])
-				return self.document_arguments[key]
+			if index < len(self.document_arguments_list):
+				return self.document_arguments[self.document_arguments_list[index]]
 		except KeyError:
 			pass
 		return default
 
 
+	def _get_document_argument_value_at(self, index):
+		# value of the registered argument at index falling back to its default
+		# if the value is missing or only whitespace
+		default = self.document_arguments_lookup[index].get('default')
+		value = self.document_arguments.get(self.document_arguments_list[index], default)
+		return value if value and not value.isspace() else default
+
+
 	def _indent_document_argument(self, arg):
 		# format indentation by modifiying label with spaces and unicode symbol
 		if "indent" in arg and arg["indent"] != None:
@@ -283,6 +404,22 @@ class HypeBaseBundle:
 	def get_save_options(self):
 		return self._save_options
 
+
+	'''
+	Capabilities
+	'''	
+
+	def register_capabilities(self, capabilities):
+		# what the manager can rely on (return them with --get_options):
+		# insert_points: list of insert points the bundle returns (others are ignored)
+		# depends_on: labels of bundles that have to run (and insert) first
+		# deterministic: same document arguments and export info give the same result
+		self._capabilities = capabilities
+
+
+	def get_capabilities(self):
+		return self._capabilities
+
 	'''
 	Helper
 	'''	
@@ -313,45 +450,90 @@ class HypeBaseBundle:
 		except Exception:
 			return False
 
+	def get_variable_as_int(self, name, default=0):
+		try:
+			return int(self.get_variable(name, default))
+		except Exception:
+			return default
+
+	'''
+	Assets
+	'''
+
+	def provide_asset(self, filepath, target_name=None):
+		# declare a static file to ship with the preview or export and return its
+		# path relative to the staging folder (to use in inserts). The declaration
+		# is returned with the result (as 'assets') and the manager places the
+		# file for fresh and cached results alike
+		target_name = target_name or os.path.basename(filepath)
+		self._assets.append({ 'path' : os.path.abspath(filepath), 'name' : target_name })
+		return target_name
+
+
+	def provide_assets(self, assets, link=None):
+		# place declared assets ({ 'path' : ..., 'name' : ... } and optionally the
+		# 'bundle' declaring it) into the staging folder. Files are stored once by
+		# content in Cache/Assets and hardlinked on previews, exports get a copy so
+		# editing them can't touch the store. A different file already at a target
+		# is kept and reported. Returns a list of problems
+		if link == None:
+			link = self.args.is_preview
+		problems = []
+		placed = {}
+		staging_path = os.path.abspath(self.args.modify_staging_path)
+		for asset in assets:
+			if not isinstance(asset, dict) or not isinstance(asset.get('path'), basestring):
+				problems.append('asset {!r} needs a path'.format(asset))
+				continue
+			filepath = _encode_path(asset['path'])
+			target_name = _encode_path(asset.get('name') or os.path.basename(filepath))
+			target_path = os.path.normpath(os.path.join(staging_path, target_name))
+			if os.path.isabs(target_name) or not target_path.startswith(staging_path+os.sep):
+				problems.append('asset {} has to stay in the export folder'.format(target_name))
+				continue
+			owner = _encode_path(asset.get('bundle') or filepath)
+			try:
+				placed_as = provide_asset(filepath, target_path, os.path.join(self.cache_folder, 'Assets'), link)
+			except (IOError, OSError) as e:
+				problems.append('asset {} could not be provided ({})'.format(filepath, e))
+				continue
+			if placed_as == 'conflict':
+				problems.append('{}: asset {} was not provided, {} already placed a different file there'.format(owner, target_name, placed.get(target_path, 'the export')))
+			else:
+				placed.setdefault(target_path, owner)
+		return problems
+
+
 	'''
 	Updates
 	'''
 	def _check_for_updates(self):
 		# extract local variables from settings dict with defaults
 		defaults_bundle_identifier = self.settings.get('defaults_bundle_identifier', ("de.hypebundles."+self.folder_name).replace(" ", ""))
-		minimum_update_check_duration_in_seconds = self.settings.get('minimum_update_check_duration_in_seconds', 10) #60 * 60 * 24)  # once a day
+		minimum_update_check_duration_in_seconds = self.settings.get('minimum_update_check_duration_in_seconds', 60 * 60 * 24) # once a day
+		update_check_timeout_in_seconds = self.settings.get('update_check_timeout_in_seconds', 2)
 		current_script_version = self.settings.get('current_script_version')
-		version_info_url = self.settings.get('version_info_url')
+		version_info_url = os.environ.get('HYPEBUNDLE_VERSION_INFO_URL', self.settings.get('version_info_url')) # stub server in tests
 		download_url = self.settings.get('download_url')
 
-		# update logic by Tumult
-		import subprocess
-		import urllib2
-		
-		last_check_timestamp = None
-		
-		try:
-			last_check_timestamp = subprocess.check_output(["defaults", "read", defaults_bundle_identifier, "last_check_timestamp"]).strip()
-			self.log("checked "+str(last_check_timestamp))
-		except:
-			pass
+		# answer from the timestamp store only, refreshing it at most once per
+		# interval in a detached process (the bundle never waits for the network,
+		# a version arriving later is stored for the next check)
+		store_path = os.path.join(self.cache_folder, 'Updates', defaults_bundle_identifier+'.json')
+		store = _read_update_store(store_path)
 
-		try:
-			timestamp_now = subprocess.check_output(["date", "+%s"]).strip()
-			self.log("now "+str(timestamp_now))
-			if (last_check_timestamp == None) or ((int(timestamp_now) - int(last_check_timestamp)) > minimum_update_check_duration_in_seconds):
-				subprocess.check_output(["defaults", "write", defaults_bundle_identifier, "last_check_timestamp", timestamp_now])
-				request = urllib2.Request(version_info_url, headers={'User-Agent' : "Magic Browser"})
-				latest_script_version = int(urllib2.urlopen(request).read().strip())
-				
-				if latest_script_version > current_script_version:
-					bundle.exit_with_result({
-						"url" : download_url, 
-						"from_version" : str(current_script_version), 
-						"to_version" : str(latest_script_version)
-					})
-		except:
-			pass
+		if version_info_url and time.time() - store.get('last_check_timestamp', 0) > minimum_update_check_duration_in_seconds:
+			store['last_check_timestamp'] = time.time()
+			_save_update_store(store_path, store)
+			_fetch_latest_version_detached(version_info_url, update_check_timeout_in_seconds, store_path)
+
+		latest_script_version = store.get('latest_script_version')
+		if latest_script_version != None and current_script_version != None and latest_script_version > current_script_version:
+			self.exit_with_result({
+				"url" : download_url, 
+				"from_version" : str(current_script_version), 
+				"to_version" : str(latest_script_version)
+			})
 
 
 
@@ -365,8 +547,12 @@ class HypeBundle(HypeBaseBundle):
 		
 		HypeBaseBundle.__init__(self, settings)
 
-		# parse args given to Python call (mainly subprocess)
-		self.parse_known_args()
+		# use prepared args if the manager runs us in-process
+		# else parse args given to Python call (mainly subprocess)
+		if 'args' in self.settings:
+			self.args = self.settings['args']
+		else:
+			self.parse_known_args()
 
 		# check for updates if possible
 		if self.args.check_for_updates:
@@ -445,24 +631,358 @@ class ManagerExtensionBundle(HypeBaseBundle):
 Render template variables (general)
 '''
 
+class Template:
+	# template parsed once into a list of segments, rendering is a single join
+	# ${name} is replaced if name is in the lookup (else kept as is) and
+	# ${ifdef name}...${else}...${endif} keeps the first part if name is set
+	# to a non empty value (the ${else} part is optional, blocks can be nested)
+
+	_token = re.compile(r'\$\{([^{}]*)\}')
+
+	def __init__(self, source):
+		self.source = source
+		self.segments = self._parse(source)
+
+
+	def render(self, *lookups):
+		# lookups are searched in the given order
+		parts = []
+		self._render(self.segments, lookups, parts)
+		return ''.join(parts)
+
+
+	def _render(self, segments, lookups, parts):
+		for segment in segments:
+			if isinstance(segment, basestring):
+				parts.append(segment)
+			elif segment[0] == 'var':
+				for lookup in lookups:
+					if segment[1] in lookup:
+						value = lookup[segment[1]]
+						parts.append(value if isinstance(value, basestring) else ('' if value == None else str(value)))
+						break
+				else:
+					parts.append(segment[2])
+			else:
+				self._render(segment[2] if self._is_defined(segment[1], lookups) else segment[3], lookups, parts)
+
+
+	def _is_defined(self, name, lookups):
+		for lookup in lookups:
+			if name in lookup:
+				return lookup[name] not in (None, '')
+		return False
+
+
+	def _parse(self, source):
+		# build nested segments: strings, ('var', name, raw) and
+		# ('ifdef', name, segments, else_segments, raw, raw_else)
+		root = []
+		stack = []
+		current = root
+		position = 0
+		for m in self._token.finditer(source):
+			if m.start() > position:
+				current.append(source[position:m.start()])
+			position = m.end()
+			content = m.group(1).strip()
+
+			if content.startswith('ifdef '):
+				block = ['ifdef', content[6:].strip(), [], [], m.group(0), None]
+				current.append(block)
+				stack.append(block)
+				current = block[2]
+			elif content == 'else' and stack and stack[-1][5] == None:
+				stack[-1][5] = m.group(0)
+				current = stack[-1][3]
+			elif content == 'endif' and stack:
+				stack.pop()
+				current = stack[-1][3 if stack[-1][5] else 2] if stack else root
+			else:
+				current.append(('var', m.group(1), m.group(0)))
+
+		if position < len(source):
+			current.append(source[position:])
+
+		# keep unclosed blocks as plain text
+		while stack:
+			block = stack.pop()
+			parent = stack[-1][3 if stack[-1][5] else 2] if stack else root
+			index = parent.index(block)
+			flat = [block[4]] + block[2] + ([block[5]] + block[3] if block[5] else [])
+			parent[index:index+1] = flat
+
+		return root
+
+
+
+# compiled templates by source
+_template_cache = {}
+
+def compile_template(string):
+	# return memoized Template for the given source
+	template = _template_cache.get(string)
+	if template == None:
+		if len(_template_cache) > 256:
+			_template_cache.clear()
+		template = _template_cache[string] = Template(string)
+	return template
+
+
 def template_variables(string, lookup):
 	try:
-		# filter out variables starting with an underscore
-		# lookup = { key:value for (key,value) in loopup.items() if key[0:1] != '_'}
-
-		# build regex pattern for one pass replacement
-		varlist = '|'.join([re.escape('${'+key+'}') for key in lookup.keys()])
-		pattern = re.compile(r'(' + varlist + r')')
-		
-		# use lambda to replace with lookup values (removing added var padding 2:-1)
-		return pattern.sub(lambda x: lookup[x.group()[2:-1]], string)
+		# render precompiled template against the lookup
+		return compile_template(string).render(lookup)
 	
 	except Exception:
 		# default to return original string if it fails
 		return string
 
-	# TODO: ${ifdef ...}
-	# think about using template, tbd: https://stackabuse.com/formatting-strings-with-the-python-template-class/
+
+'''
+Result channel
+'''
+
+def write_result_frames(fd, result):
+	# write result to the manager: inserts as raw text frames, patches and
+	# everything else as JSON, closed by an end frame
+	def frame(kind, name, payload):
+		if isinstance(payload, unicode):
+			payload = payload.encode('utf-8')
+		channel.write('%s %s %d\n' % (kind, name, len(payload)))
+		channel.write(payload)
+
+	with os.fdopen(fd, 'wb') as channel:
+		channel.write('%s %d\n' % (RESULT_CHANNEL_MAGIC, RESULT_CHANNEL_VERSION))
+		rest = result
+		if isinstance(result, dict):
+			rest = {}
+			for key, value in result.items():
+				if key.startswith('insert_') and isinstance(value, basestring):
+					frame('insert', key, value)
+				elif key == 'patch_generated_script':
+					frame('patch', key, json.dumps(value))
+				else:
+					rest[key] = value
+		frame('result', '-', json.dumps(rest))
+		frame('end', '-', '')
+
+
+def read_result_frames(channel):
+	# yield (kind, name, payload) frames from a file object as they arrive,
+	# stops after the end frame or when the channel closes
+	header = channel.readline()
+	if not header:
+		return
+	magic, version = header.split()
+	if magic != RESULT_CHANNEL_MAGIC or int(version) != RESULT_CHANNEL_VERSION:
+		raise ValueError('unsupported result channel: '+header.strip())
+
+	while True:
+		line = channel.readline()
+		if not line:
+			return
+		kind, name, length = line.split()
+		payload = channel.read(int(length))
+		if kind == 'end':
+			return
+		yield kind, name, payload
+
+
+'''
+Logging
+'''
+
+class BundleLogger:
+	# buffered log file with levels and size based rotation (<name>.log.1 is the
+	# newest backup). Lines are written when flushed, unflushed logs are flushed
+	# when the process exits
+
+	levels = { 'debug' : 10, 'info' : 20, 'timing' : 25, 'warning' : 30, 'error' : 40 }
+
+	# timing records are lines with level TIMING and "<marker><step>\t<seconds>"
+	timing_marker = 'step '
+	timing_pattern = re.compile(r'^(\S+ \S+) TIMING +step (.*)\t([0-9.]+)$', re.MULTILINE)
+
+	def __init__(self, filepath, level='info', max_size=1024*1024, backups=3):
+		self.filepath = filepath
+		self.level = self.levels.get(str(level).lower(), self.levels['info'])
+		self.max_size = max_size
+		self.backups = backups
+		self._lines = []
+		self._truncate = False
+		self._lock = threading.Lock()
+
+
+	def write(self, content, level='info', truncate=False):
+		if self.levels.get(level, self.levels['info']) < self.level:
+			return
+		if isinstance(content, unicode):
+			content = content.encode('utf-8')
+		now = time.time()
+		line = '{}.{:03d} {:<7} {}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)), int(now*1000)%1000, level.upper(), content)
+		with self._lock:
+			if truncate:
+				self._lines = []
+				self._truncate = True
+			self._lines.append(line)
+			_unflushed_loggers.add(self)
+
+
+	def flush(self):
+		with self._lock:
+			lines, truncate = self._lines, self._truncate
+			self._lines, self._truncate = [], False
+			_unflushed_loggers.discard(self)
+		if not lines and not truncate:
+			return
+		data = ''.join(lines)
+		try:
+			size = 0 if truncate else os.path.getsize(self.filepath)
+		except OSError:
+			size = 0
+		if size and size + len(data) > self.max_size:
+			self._rotate()
+			size = 0
+		with open(self.filepath, 'w' if truncate else 'a') as f:
+			f.write(data)
+
+
+	def _rotate(self):
+		# name.log -> name.log.1 -> ... -> name.log.<backups> (dropped after that)
+		for index in range(self.backups, 0, -1):
+			source = self.filepath + ('.'+str(index-1) if index > 1 else '')
+			if os.path.exists(source):
+				os.rename(source, self.filepath+'.'+str(index))
+		if os.path.exists(self.filepath):
+			os.remove(self.filepath)
+
+
+# loggers with buffered lines
+_unflushed_loggers = set()
+
+@atexit.register
+def _flush_loggers():
+	for logger in list(_unflushed_loggers):
+		try:
+			logger.flush()
+		except Exception:
+			pass
+
+
+'''
+Update checks
+'''
+
+def _fetch_latest_version(version_info_url, timeout, store_path, store):
+	# request the latest version (the endpoint only returns a number) and store it
+	import urllib2
+	try:
+		request = urllib2.Request(version_info_url, headers={'User-Agent' : "Magic Browser"})
+		store['latest_script_version'] = int(urllib2.urlopen(request, timeout=timeout).read().strip())
+		_save_update_store(store_path, store)
+	except Exception:
+		pass
+
+
+def _fetch_latest_version_detached(version_info_url, timeout, store_path):
+	# run _fetch_latest_version in a process of its own that outlives the bundle
+	with open(os.devnull, 'r+') as devnull:
+		subprocess.Popen(
+			[sys.executable or 'python', os.path.splitext(os.path.abspath(__file__))[0]+'.py', '--fetch_latest_version', version_info_url, str(timeout), store_path],
+			stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid
+		)
+
+
+def _read_update_store(store_path):
+	try:
+		with open(store_path, 'r') as f:
+			return json.load(f)
+	except (IOError, OSError, ValueError):
+		return {}
+
+
+def _save_update_store(store_path, store):
+	# write atomically, a failing write only means checking again next time
+	try:
+		folder = os.path.dirname(store_path)
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+		handle, temp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+		with os.fdopen(handle, 'w') as f:
+			json.dump(store, f)
+		os.rename(temp_path, store_path)
+	except (IOError, OSError):
+		pass
+
+
+'''
+Assets (shared by all bundles)
+'''
+
+# content digests by (filepath, size, mtime)
+_asset_digests = {}
+
+def provide_asset(filepath, target_path, store_folder, link=True):
+	# place the content of filepath at target_path from the content hashed store
+	# returns 'kept' if target_path already had it, 'conflict' if it has other
+	# content (left as is) else 'linked' or 'copied'
+	store_path = _store_asset(filepath, store_folder)
+
+	# identical assets from several bundles end up once at the same target,
+	# a different file is never replaced (the first to claim a name keeps it)
+	if os.path.exists(target_path):
+		if os.path.samefile(store_path, target_path) or _asset_digest(target_path) == _asset_digest(filepath):
+			return 'kept'
+		return 'conflict'
+
+	folder = os.path.dirname(target_path)
+	if folder and not os.path.isdir(folder):
+		os.makedirs(folder)
+
+	if link:
+		try:
+			os.link(store_path, target_path)
+			return 'linked'
+		except OSError:
+			# other volume or no hardlink support
+			pass
+	shutil.copyfile(store_path, target_path)
+	return 'copied'
+
+
+def _encode_path(path):
+	# paths from JSON results are unicode
+	return path.encode('utf-8') if isinstance(path, unicode) else path
+
+
+def _store_asset(filepath, store_folder):
+	# path of the stored copy (<sha1><extension>), adding it if needed
+	store_path = os.path.join(store_folder, _asset_digest(filepath)+os.path.splitext(filepath)[1])
+	if not os.path.exists(store_path):
+		if not os.path.isdir(store_folder):
+			os.makedirs(store_folder)
+		handle, temp_path = tempfile.mkstemp(dir=store_folder, suffix='.tmp')
+		os.close(handle)
+		shutil.copyfile(filepath, temp_path)
+		# stored files are shared by hardlinks, keep them read-only
+		os.chmod(temp_path, stat_module.S_IRUSR | stat_module.S_IRGRP | stat_module.S_IROTH)
+		os.rename(temp_path, store_path)
+	return store_path
+
+
+def _asset_digest(filepath):
+	stat = os.stat(filepath)
+	key = (filepath, stat.st_size, stat.st_mtime)
+	digest = _asset_digests.get(key)
+	if digest == None:
+		sha1 = hashlib.sha1()
+		with open(filepath, 'rb') as f:
+			for chunk in iter(lambda: f.read(65536), ''):
+				sha1.update(chunk)
+		digest = _asset_digests[key] = sha1.hexdigest()
+	return digest
+
 
 def read_content(filepath):
 	with open(filepath, "r") as f:
@@ -472,3 +992,10 @@ def save_content(filepath, content):
 	with open(filepath, "w") as f:
 		f.write(content)
 		#f.write(content.encode('utf-8'))
+
+
+
+if __name__ == "__main__":
+	# detached update fetch started by _check_for_updates
+	if len(sys.argv) == 5 and sys.argv[1] == '--fetch_latest_version':
+		_fetch_latest_version(sys.argv[2], float(sys.argv[3]), sys.argv[4], _read_update_store(sys.argv[4]))
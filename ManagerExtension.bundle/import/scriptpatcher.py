@@ -0,0 +1,350 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# 	scriptpatcher.py
+#	Apply patch_generated_script patches of all bundles in one pass
+#
+#	 v1.0.0 Initial release
+#	 v1.0.1 own patterns for backreferences and inline flags, overlap conflicts
+#	 v1.0.2 all patterns search the original script, written in one pass
+#
+#	Bundles return patches as list (or single dict) in patch_generated_script:
+#	 { 'find' : 'literal text', 'replace' : 'literal replacement' }
+#	 { 'regex' : 'pattern', 'replace' : 'template with \\1 or \\g<name>' }
+#	optional keys: 'count' (most replacements per script, default all) and
+#	'optional' (True to not report the patch if it never applied)
+#
+#
+#	MIT License
+#	Copyright (c) 2021 Max Ziebell
+#
+
+import os
+import re
+import mmap
+import tempfile
+import StringIO
+
+
+# Python 2.7 compiles at most 100 groups per pattern (group 0 included)
+max_groups_per_pattern = 99
+
+# escapes, conditionals and inline flags in patterns. Numbered backreferences
+# and conditionals would point to other groups once the pattern is wrapped and
+# inline flags apply to the whole pattern, so such patches get their own
+solo_syntax_pattern = re.compile(r'\\.|\(\?\(|\(\?[iLmsux]+\)')
+
+# numbered group references in replacement templates (escaped backslashes
+# are matched to be skipped, \0 is an octal escape and no reference)
+template_reference_pattern = re.compile(r'\\\\|\\([1-9]\d?)|\\g<(\d+)>')
+
+# largest slice copied at once when streaming unchanged parts of a script
+stream_chunk_size = 1024*1024
+
+
+
+'''
+Collect patches
+'''
+
+def label_patches(label, value):
+	# patches of a bundle result as list of dicts with the bundle label
+	if isinstance(value, dict):
+		value = [value]
+	if not isinstance(value, list):
+		return []
+	return [dict(_encode_strings(patch), bundle=label) for patch in value if isinstance(patch, dict)]
+
+
+def _encode_strings(value):
+	# results from JSON are unicode, scripts are utf-8 encoded strings
+	if isinstance(value, dict):
+		return dict((_encode_strings(key), _encode_strings(item)) for key, item in value.items())
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+
+
+class ScriptPatcher:
+	# all patches compiled into as few combined patterns as possible (one unless
+	# the group limit, clashing group names, backreferences or inline flags
+	# require more). Every pattern searches the original script and the script
+	# is written in one pass, so no patch sees the replacements of another.
+	# Where matches of two patches overlap the first wins (at the same place
+	# the patch given first) and the overlap is reported as conflict
+
+	'''
+	Constructor and basics
+	'''
+
+	def __init__(self, patches):
+		self.patches = []
+		self.problems = []
+		self.batches = []
+		self.counts = []
+		self.shadowed = {}
+
+		seen = {}
+		for patch in patches:
+			patch = self._prepare(patch, seen)
+			if patch:
+				self.patches.append(patch)
+				self.counts.append(0)
+
+		self._find_contained()
+		self._compile()
+
+
+	def _prepare(self, patch, seen):
+		# validate a patch and return it with its compiled pattern, None to skip it
+		label = patch.get('bundle', 'unknown bundle')
+		if ('find' in patch) == ('regex' in patch):
+			self.problems.append('{}: a patch needs either find or regex'.format(label))
+			return None
+		kind = 'find' if 'find' in patch else 'regex'
+		source = patch[kind]
+		replace = patch.get('replace', '')
+		if not isinstance(source, basestring) or not source or not isinstance(replace, basestring):
+			self.problems.append('{}: {} and replace of a patch have to be text'.format(label, kind))
+			return None
+
+		# the first patch wins, later ones for the same text are conflicts
+		if (kind, source) in seen:
+			self.problems.append('{} and {} both patch {} {!r}, only the first is applied'.format(seen[(kind, source)], label, kind, source))
+			return None
+
+		pattern = re.escape(source) if kind == 'find' else source
+		try:
+			compiled = re.compile(pattern)
+		except re.error as e:
+			self.problems.append('{}: invalid regex {!r} ({})'.format(label, source, e))
+			return None
+		if compiled.match(''):
+			self.problems.append('{}: regex {!r} matches empty text'.format(label, source))
+			return None
+
+		seen[(kind, source)] = label
+		return {
+			'bundle' : label,
+			'kind' : kind,
+			'source' : source,
+			'pattern' : pattern,
+			'groups' : compiled.groups,
+			'names' : set(compiled.groupindex),
+			'solo' : kind == 'regex' and _needs_own_pattern(pattern),
+			'replace' : replace,
+			'count' : patch.get('count') or 0,
+			'optional' : bool(patch.get('optional')),
+		}
+
+
+	def _find_contained(self):
+		# a find that is part of another one never applies where both match
+		# (matches starting at the same place are not caught while patching)
+		finds = [patch for patch in self.patches if patch['kind'] == 'find']
+		for patch in finds:
+			for other in finds:
+				if patch is not other and patch['source'] in other['source']:
+					self.problems.append('{}: find {!r} is part of find {!r} of {}, only one applies where both match'.format(patch['bundle'], patch['source'], other['source'], other['bundle']))
+
+
+	def _compile(self):
+		# wrap every patch in a group and join them into alternations, a new
+		# pattern starts when the group limit is reached or group names clash
+		batch = []
+		groups = 0
+		names = set()
+		for index, patch in enumerate(self.patches):
+			if patch['solo']:
+				# keep the order in which patches apply
+				if batch:
+					self._add_batch(batch)
+					batch, groups, names = [], 0, set()
+				self._add_solo_batch(index)
+				continue
+			needed = patch['groups'] + 1
+			if batch and (groups + needed > max_groups_per_pattern or names & patch['names']):
+				self._add_batch(batch)
+				batch, groups, names = [], 0, set()
+			batch.append(index)
+			groups += needed
+			names |= patch['names']
+		if batch:
+			self._add_batch(batch)
+
+
+	def _add_batch(self, indexes):
+		# lookup by the number of the wrapping group (the last to close on a match,
+		# so it is m.lastindex) to patch index and literal or offset template
+		parts = []
+		lookup = {}
+		group = 1
+		for index in indexes:
+			patch = self.patches[index]
+			parts.append('('+patch['pattern']+')')
+			if patch['kind'] == 'find':
+				lookup[group] = (index, patch['replace'], None)
+			else:
+				lookup[group] = (index, None, _offset_template(patch['replace'], group))
+			group += patch['groups'] + 1
+		try:
+			self.batches.append((re.compile('|'.join(parts)), lookup))
+		except re.error:
+			# patches that only compile on their own
+			for index in indexes:
+				self._add_solo_batch(index)
+
+
+	def _add_solo_batch(self, index):
+		# a pattern of its own, not wrapped so groups keep their numbers
+		patch = self.patches[index]
+		if patch['kind'] == 'find':
+			lookup = { None : (index, patch['replace'], None) }
+		else:
+			lookup = { None : (index, None, patch['replace']) }
+		self.batches.append((re.compile(patch['pattern']), lookup))
+
+
+	'''
+	Apply
+	'''
+
+	def apply(self, text):
+		# return patched text (counts are added to self.counts)
+		output = StringIO.StringIO()
+		self._write_patched(text, output)
+		return output.getvalue()
+
+
+	def patch_file(self, filepath):
+		# stream the patched content of filepath into a temporary file next to
+		# it and return its path, None if there are no patches
+		if not self.batches:
+			return None
+		handle, target_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filepath)), suffix='.tmp')
+		try:
+			with open(filepath, 'rb') as source, os.fdopen(handle, 'wb') as target:
+				size = os.fstat(source.fileno()).st_size
+				data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) if size else ''
+				try:
+					self._write_patched(data, target)
+				finally:
+					if size:
+						data.close()
+		except Exception:
+			os.remove(target_path)
+			raise
+		return target_path
+
+
+	def _write_patched(self, data, target):
+		# every batch keeps its next match in data, the one starting first is
+		# patched and matches (of any batch) starting inside it are overlaps.
+		# Overlapped batches search again from the end of the patched match, the
+		# patched batch also searches right after its start to find overlaps of
+		# its own, so there is at most one extra search per patch or overlap
+		candidates = [self._next_match(batch, data, 0) for batch in self.batches]
+		position = 0
+		while True:
+			first = None
+			for number, m in enumerate(candidates):
+				if m and (first == None or (m.start(), self._patch_of(number, m)) < (candidates[first].start(), self._patch_of(first, candidates[first]))):
+					first = number
+			if first == None:
+				break
+
+			m = candidates[first]
+			start, end = m.span()
+			index, literal, template = _lookup_match(self.batches[first][1], m)
+			self.counts[index] += 1
+			_write_range(target, data, position, start)
+			target.write(literal if template == None else m.expand(template))
+			position = end
+
+			candidates[first] = self._next_match(self.batches[first], data, start+1)
+			for number, other in enumerate(candidates):
+				if other and other.start() < end:
+					other_index = self._patch_of(number, other)
+					if other_index != index:
+						self.shadowed[(index, other_index)] = self.shadowed.get((index, other_index), 0) + 1
+					candidates[number] = self._next_match(self.batches[number], data, end)
+		_write_range(target, data, position, len(data))
+
+
+	def _next_match(self, batch, data, position):
+		# first match of batch from position whose patch didn't reach its count
+		compiled, lookup = batch
+		m = compiled.search(data, position)
+		while m:
+			index = _lookup_match(lookup, m)[0]
+			if not self.patches[index]['count'] or self.counts[index] < self.patches[index]['count']:
+				return m
+			m = compiled.search(data, m.start()+1)
+		return None
+
+
+	def _patch_of(self, number, m):
+		# index of the patch a match of batch number belongs to
+		return _lookup_match(self.batches[number][1], m)[0]
+
+
+	'''
+	Reports
+	'''
+
+	def add_counts(self, counts, shadowed=()):
+		# merge counts and overlaps of patchers that ran in other processes
+		for index, count in enumerate(counts):
+			self.counts[index] += count
+		for pair, count in shadowed:
+			self.shadowed[pair] = self.shadowed.get(pair, 0) + count
+
+
+	def conflicts(self):
+		# problems for matches that were not patched because they overlapped
+		# the match of another patch
+		problems = []
+		for (index, other), count in sorted(self.shadowed.items()):
+			patch, shadowed = self.patches[index], self.patches[other]
+			problems.append('{}: {} {!r} overlapped {} {!r} of {} {} times, only the first match was patched'.format(
+				shadowed['bundle'], shadowed['kind'], shadowed['source'], patch['kind'], patch['source'], patch['bundle'], count))
+		return problems
+
+
+	def unapplied(self):
+		# problems for patches that never applied (unless optional)
+		return ['{}: {} {!r} never applied'.format(patch['bundle'], patch['kind'], patch['source'])
+			for patch, count in zip(self.patches, self.counts) if count == 0 and not patch['optional']]
+
+
+
+def _needs_own_pattern(pattern):
+	# numbered backreferences, conditionals or inline flags (see solo_syntax_pattern)
+	for syntax in solo_syntax_pattern.findall(pattern):
+		if syntax[0] != '\\' or syntax[1] in '123456789':
+			return True
+	return False
+
+
+def _offset_template(template, offset):
+	# shift numbered group references by the number of the wrapping group
+	def shift(m):
+		if m.group(1) == None and m.group(2) == None:
+			return m.group(0)
+		number = int(m.group(1) or m.group(2))
+		return '\\g<{}>'.format(number + offset)
+	return template_reference_pattern.sub(shift, template)
+
+
+def _lookup_match(lookup, m):
+	# patch index, literal and template of a match (see ScriptPatcher._add_batch)
+	return lookup[None] if None in lookup else lookup[m.lastindex]
+
+
+def _write_range(target, data, start, end):
+	# write data[start:end] in slices of at most stream_chunk_size
+	while start < end:
+		stop = min(end, start+stream_chunk_size)
+		target.write(data[start:stop])
+		start = stop
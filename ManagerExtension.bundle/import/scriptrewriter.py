@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# 	scriptrewriter.py
+#	Helper functions to rewrite the Hype generated script
+#
+#	 v1.0.0 Initial release, single pass function unpacking
+#	 v1.0.1 two pass rewrite streaming from and to files
+#	 v1.0.2 rewrite several generated scripts in a process pool
+#	 v1.0.3 apply bundle patches before unpacking
+#
+#
+#	MIT License
+#	Copyright (c) 2021 Max Ziebell
+#
+
+import os
+import re
+import mmap
+import tempfile
+import multiprocessing
+
+from closurecompiler import ClosureCache, get_closure_backend, compile_units_with_closure
+from scriptpatcher import ScriptPatcher
+
+
+# hype function regex with Friedl's "unrolled loop"
+hype_function_pattern = re.compile(r'name:"(.*?)",source:"([^"\\]*(?:\\.[^"\\]*)*)"')
+
+# signature of Hype functions (gets a line break when unpacked)
+hype_function_signature = "function(hypeDocument, element, event) {"
+
+# function sources and relative hypeDocument calls in one alternation (group 3)
+generated_script_pattern = re.compile(hype_function_pattern.pattern + r'|(s:"hypeDocument\.)')
+
+# largest slice copied at once when streaming unchanged parts of a script
+stream_chunk_size = 1024*1024
+
+
+'''
+Unpack Hype functions
+'''
+
+def unpack_hype_functions(generated_script, hype_document_name):
+	# replace the source of every Hype function with a reference to HYPE_functions
+	# and extract the functions in the same pass over the generated script.
+	# returns the rewritten script and a list with one JavaScript unit per function
+	hype_functions = []
+	prefix = 'HYPE_functions[\\"'+hype_document_name+'\\"].'
+
+	def unpack(m):
+		name, source = m.group(1), m.group(2)
+		new_name, unit = _unpack_hype_function(prefix, name, source)
+		hype_functions.append(unit)
+		return 'name:"'+name+'",source:"'+new_name+'"'
+
+	return hype_function_pattern.sub(unpack, generated_script), hype_functions
+
+
+def _unpack_hype_function(prefix, name, source):
+	# new name and JavaScript unit of a Hype function
+	new_name = prefix+name
+	function_raw = source.replace(hype_function_signature, hype_function_signature+"\n")
+	return new_name, "\n"+new_name.decode('string_escape')+" = "+function_raw.decode('string_escape')+";\n//"+source+"\n"
+
+
+
+'''
+Rewrite generated script files
+'''
+
+def scan_generated_script(generated_script, hype_document_name):
+	# first pass: collect the edits as (start, end, replacement) and the
+	# JavaScript unit of every Hype function. Works on strings and mmaps
+	edits = []
+	hype_functions = []
+	prefix = 'HYPE_functions[\\"'+hype_document_name+'\\"].'
+	document = 's:"HYPE.documents[\\"'+hype_document_name+'\\"].'
+
+	for m in generated_script_pattern.finditer(generated_script):
+		if m.group(3):
+			# replace relative with absolute calls
+			edits.append((m.start(), m.end(), document))
+		else:
+			name, source = m.group(1), m.group(2)
+			new_name, unit = _unpack_hype_function(prefix, name, source)
+			hype_functions.append(unit)
+			edits.append((m.start(), m.end(), 'name:"'+name+'",source:"'+new_name+'"'))
+
+	return edits, hype_functions
+
+
+def write_generated_script(target, generated_script, edits):
+	# second pass: stream the script with the edits applied to a file object
+	position = 0
+	for start, end, replacement in edits:
+		_write_range(target, generated_script, position, start)
+		target.write(replacement)
+		position = end
+	_write_range(target, generated_script, position, len(generated_script))
+
+
+def rewrite_generated_script_file(filepath, hype_document_name, build_script_additions, patcher=None):
+	# rewrite a generated script in place without holding it in memory. The
+	# file is mapped, scanned once for edits and Hype functions, and the
+	# additions (built by build_script_additions from the list of Hype function
+	# units) plus the rewritten script are streamed into a temporary file that
+	# replaces the original. Patches of a ScriptPatcher are applied first so they
+	# see the script as Hype generated it. Returns the list of Hype function units
+	mode = os.stat(filepath).st_mode
+	patched_path = patcher.patch_file(filepath) if patcher else None
+	try:
+		return _rewrite_generated_script(filepath, patched_path or filepath, mode, hype_document_name, build_script_additions)
+	finally:
+		if patched_path and os.path.exists(patched_path):
+			os.remove(patched_path)
+
+
+def _rewrite_generated_script(filepath, source_path, mode, hype_document_name, build_script_additions):
+	with open(source_path, 'rb') as source:
+		stat = os.fstat(source.fileno())
+		generated_script = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else ''
+		try:
+			edits, hype_functions = scan_generated_script(generated_script, hype_document_name)
+			script_additions = build_script_additions(hype_functions)
+			if isinstance(script_additions, unicode):
+				script_additions = script_additions.encode('utf-8')
+
+			handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filepath)), suffix='.tmp')
+			try:
+				with os.fdopen(handle, 'wb') as target:
+					target.write(script_additions)
+					target.write("\n")
+					write_generated_script(target, generated_script, edits)
+				os.chmod(temp_path, mode & 0777)
+				os.rename(temp_path, filepath)
+			except Exception:
+				if os.path.exists(temp_path):
+					os.remove(temp_path)
+				raise
+		finally:
+			if stat.st_size:
+				generated_script.close()
+	return hype_functions
+
+
+def _write_range(target, data, start, end):
+	# write data[start:end] in slices of at most stream_chunk_size
+	while start < end:
+		stop = min(end, start+stream_chunk_size)
+		target.write(data[start:stop])
+		start = stop
+
+
+
+'''
+Rewrite several generated scripts
+'''
+
+def rewrite_generated_scripts(filepaths, hype_document_name, options, max_workers=1):
+	# rewrite generated scripts concurrently in up to max_workers processes
+	# (scripts are independent once the bundle inserts are known) and return
+	# a report per script in the order of filepaths. The options are plain
+	# values so they can be handed to the pool:
+	#	functions_header, document_load, insert_into_generated_script and
+	#	closure (None or a dict with local and cache_folder) and
+	#	patches (labelled patches, see scriptpatcher)
+	tasks = [(filepath, hype_document_name, options) for filepath in filepaths]
+	if max_workers <= 1 or len(tasks) < 2:
+		return [rewrite_generated_script_task(task) for task in tasks]
+
+	pool = multiprocessing.Pool(min(max_workers, len(tasks)))
+	try:
+		return pool.map(rewrite_generated_script_task, tasks)
+	finally:
+		pool.close()
+		pool.join()
+
+
+def rewrite_generated_script_task(task):
+	# rewrite a single generated script and report closure errors, warnings,
+	# cache hits and misses and how often every patch applied (or overlapped
+	# another one) back to the manager
+	filepath, hype_document_name, options = task
+	report = { 'filepath' : filepath, 'errors' : '', 'warnings' : '', 'hits' : 0, 'misses' : 0, 'patch_counts' : [], 'patch_shadowed' : [] }
+	patcher = ScriptPatcher(options['patches']) if options.get('patches') else None
+
+	def build_script_additions(hype_functions):
+		closure = options.get('closure')
+		if closure:
+			# compile actions, every hype function and every bundle addition as its own
+			# unit so an edit only recompiles (and misses the cache for) what changed
+			script_units = [options['functions_header']] + hype_functions + [options['document_load']] + options['insert_into_generated_script']
+			cache = ClosureCache(closure['cache_folder'])
+			script_additions, report['errors'], report['warnings'] = compile_units_with_closure(script_units, cache, get_closure_backend(closure['local']))
+			report['hits'], report['misses'] = cache.hits, cache.misses
+			return script_additions
+
+		# add javascript for actions and hype functions
+		script_additions = options['functions_header']+"\n"+"".join(hype_functions)+"\n"+options['document_load']
+
+		# add further addition from the bundles
+		if len(options['insert_into_generated_script']):
+			script_additions += "\n".join(options['insert_into_generated_script'])
+
+		return script_additions
+
+	rewrite_generated_script_file(filepath, hype_document_name, build_script_additions, patcher)
+	if patcher:
+		report['patch_counts'] = patcher.counts
+		report['patch_shadowed'] = patcher.shadowed.items()
+	return report
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#	test_scriptpatcher.py
+#	Regression tests for applying patch_generated_script patches
+#
+#	Usage: python test_scriptpatcher.py (or python -m unittest discover Tests)
+#
+#	MIT License
+#	Copyright (c) 2021 Max Ziebell
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+repository_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(repository_folder, 'ManagerExtension.bundle', 'import'))
+from scriptpatcher import ScriptPatcher, label_patches
+
+
+def patched(patches, text):
+	# patcher that applied patches (labelled bundle 0, 1, ...) and its output
+	labelled = []
+	for number, patch in enumerate(patches):
+		labelled.extend(label_patches('bundle {}'.format(number), patch))
+	patcher = ScriptPatcher(labelled)
+	return patcher, patcher.apply(text)
+
+
+
+class TestReplacements(unittest.TestCase):
+
+	def test_find_is_literal(self):
+		patcher, text = patched([{ 'find' : 'a.b', 'replace' : '\\1' }], 'a.b axb')
+		self.assertEqual(text, '\\1 axb')
+		self.assertEqual(patcher.counts, [1])
+
+	def test_numbered_references_point_to_own_groups(self):
+		# the second patch is wrapped after the first one in a combined pattern
+		patcher, text = patched([
+			{ 'regex' : '(x)(y)', 'replace' : '\\2\\1' },
+			{ 'regex' : '(a)(b)', 'replace' : '\\2\\1' },
+			{ 'regex' : '(?P<first>c)(d)', 'replace' : '\\g<2>\\g<first>' },
+		], 'xy ab cd')
+		self.assertEqual(len(patcher.batches), 1)
+		self.assertEqual(text, 'yx ba dc')
+
+	def test_whole_match_reference(self):
+		patcher, text = patched([
+			{ 'find' : 'q', 'replace' : 'Q' },
+			{ 'regex' : 'b+', 'replace' : '[\\g<0>]' },
+		], 'q bb')
+		self.assertEqual(text, 'Q [bb]')
+
+	def test_escaped_backslash_is_no_reference(self):
+		patcher, text = patched([
+			{ 'find' : 'q', 'replace' : 'Q' },
+			{ 'regex' : '(b)', 'replace' : '\\\\1\\1' },
+		], 'q b')
+		self.assertEqual(text, 'Q \\1b')
+
+	def test_backreference_in_pattern_gets_own_pattern(self):
+		patcher, text = patched([
+			{ 'find' : 'q', 'replace' : 'Q' },
+			{ 'regex' : '(o)\\1', 'replace' : '0' },
+		], 'q oo o')
+		self.assertEqual(len(patcher.batches), 2)
+		self.assertEqual(text, 'Q 0 o')
+
+	def test_inline_flags_only_apply_to_their_patch(self):
+		patcher, text = patched([
+			{ 'regex' : '(?i)foo', 'replace' : 'x' },
+			{ 'find' : 'BAR', 'replace' : 'y' },
+		], 'FOO bar BAR')
+		self.assertEqual(text, 'x bar y')
+
+	def test_more_groups_than_one_pattern_holds(self):
+		patches = [{ 'regex' : '(a{})(b)'.format(number), 'replace' : '\\g<2>{}'.format(number) } for number in range(60)]
+		patcher, text = patched(patches, ' '.join('a{}b'.format(number) for number in range(60)))
+		self.assertTrue(len(patcher.batches) > 1)
+		self.assertEqual(text, ' '.join('b{}'.format(number) for number in range(60)))
+
+
+
+class TestCounts(unittest.TestCase):
+
+	def test_count_limits_replacements(self):
+		patcher, text = patched([{ 'find' : 'a', 'replace' : 'b', 'count' : 2 }], 'aaaa')
+		self.assertEqual(text, 'bbaa')
+		self.assertEqual(patcher.counts, [2])
+
+	def test_exhausted_patch_leaves_room_for_others(self):
+		patcher, text = patched([
+			{ 'find' : 'ab', 'replace' : 'X', 'count' : 1 },
+			{ 'find' : 'b', 'replace' : 'Y' },
+		], 'abab')
+		self.assertEqual(text, 'XaY')
+		self.assertEqual(patcher.counts, [1, 1])
+
+	def test_unapplied_unless_optional(self):
+		patcher, text = patched([
+			{ 'find' : 'missing', 'replace' : '' },
+			{ 'find' : 'absent', 'replace' : '', 'optional' : True },
+		], 'text')
+		self.assertEqual(len(patcher.unapplied()), 1)
+
+
+
+class TestConflicts(unittest.TestCase):
+
+	def test_overlap_in_one_pattern(self):
+		patcher, text = patched([
+			{ 'find' : 'abc', 'replace' : 'X' },
+			{ 'find' : 'bcd', 'replace' : 'Y' },
+		], 'abcd')
+		self.assertEqual(text, 'Xd')
+		self.assertEqual(patcher.shadowed, { (0, 1) : 1 })
+		self.assertEqual(len(patcher.conflicts()), 1)
+
+	def test_overlap_across_patterns(self):
+		patcher, text = patched([
+			{ 'regex' : '(?i)foob', 'replace' : 'X' },
+			{ 'find' : 'bar', 'replace' : 'Y' },
+		], 'foobar')
+		self.assertEqual(len(patcher.batches), 2)
+		self.assertEqual(text, 'Xar')
+		self.assertEqual(patcher.shadowed, { (0, 1) : 1 })
+
+	def test_patches_never_see_replacements(self):
+		patcher, text = patched([
+			{ 'regex' : '(?i)foo', 'replace' : 'bar' },
+			{ 'find' : 'bar', 'replace' : 'baz' },
+		], 'foo')
+		self.assertEqual(text, 'bar')
+		self.assertEqual(patcher.counts, [1, 0])
+		self.assertEqual(len(patcher.unapplied()), 1)
+
+	def test_same_place_first_patch_wins(self):
+		for patches, expected in [
+			([{ 'find' : 'ab', 'replace' : '1' }, { 'regex' : '(?i)abc', 'replace' : '2' }], ('1c', (0, 1))),
+			([{ 'regex' : '(?i)abc', 'replace' : '2' }, { 'find' : 'ab', 'replace' : '1' }], ('2', (0, 1))),
+		]:
+			patcher, text = patched(patches, 'abc')
+			self.assertEqual((text, patcher.shadowed.keys()[0]), expected)
+
+	def test_result_does_not_depend_on_batches(self):
+		patches = [
+			{ 'find' : 'cd', 'replace' : '1' },
+			{ 'regex' : '(?i)bc', 'replace' : '2' },
+			{ 'regex' : '(e)\\1', 'replace' : '3' },
+			{ 'find' : 'de', 'replace' : '4' },
+		]
+		combined, text = patched([dict(patch, regex=patch['regex'].replace('(?i)', '')) if 'regex' in patch and '(?i)' in patch['regex'] else patch for patch in patches], 'abcdeef')
+		separate, separate_text = patched(patches, 'abcdeef')
+		self.assertTrue(len(separate.batches) > len(combined.batches))
+		self.assertEqual(separate_text, text)
+		self.assertEqual(separate.shadowed, combined.shadowed)
+
+
+
+class TestPatchFile(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def test_patch_file_matches_apply(self):
+		filepath = os.path.join(self.folder, 'script.js')
+		content = 'var foo = "bar";\n' * 1000
+		with open(filepath, 'wb') as f:
+			f.write(content)
+		patches = label_patches('bundle', [{ 'regex' : '(?i)FOO', 'replace' : 'x' }, { 'find' : 'bar', 'replace' : 'y' }])
+		patched_path = ScriptPatcher(patches).patch_file(filepath)
+		with open(patched_path, 'rb') as f:
+			self.assertEqual(f.read(), ScriptPatcher(patches).apply(content))
+		with open(filepath, 'rb') as f:
+			self.assertEqual(f.read(), content)
+
+	def test_empty_file(self):
+		filepath = os.path.join(self.folder, 'empty.js')
+		open(filepath, 'wb').close()
+		patched_path = ScriptPatcher(label_patches('bundle', { 'find' : 'a', 'replace' : 'b' })).patch_file(filepath)
+		self.assertEqual(os.path.getsize(patched_path), 0)
+
+
+
+if __name__ == '__main__':
+	unittest.main()